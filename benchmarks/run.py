@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for quinoa and its dice bot, run against a fake connection.
+
+    python benchmarks/run.py [-k pattern] [--no-save]
+
+Each benchmark reports the best time per operation over several rounds.
+Results are saved to benchmarks/results/<version>.json and compared with
+the newest results from an earlier version, so regressions stand out
+between releases.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import platform
+from optparse import OptionParser
+from distutils.version import LooseVersion
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'src'))
+
+from quinoa import Bot
+from quinoa.testing import Harness
+
+RESULTS = os.path.join(HERE, 'results')
+# Slowdowns beyond this fraction are reported as regressions.
+THRESHOLD = 0.10
+
+BENCHMARKS = []
+
+def benchmark(name, number=1000):
+    """
+    Register a benchmark: a function that does any setup, then returns a
+    function to time, which is called number times a round.
+    """
+    def register(setup):
+        BENCHMARKS.append((name, setup, number))
+        return setup
+    return register
+
+def measure(op, number, rounds=5):
+    """Best seconds per call to op over rounds rounds of number calls."""
+    best = None
+    for i in range(rounds):
+        start = time.time()
+        for j in xrange(number):
+            op()
+        elapsed = (time.time() - start) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+# ~~~~~~~ Dispatch
+
+class TableBot(Bot):
+    # Time the lookup itself, not the cache in front of it.
+    command_cache_size = 0
+    size = 0
+    def reply(self, msg):
+        return "ok"
+    def register_commands(self):
+        for i in range(self.size):
+            self.commands[r'[Cc]ommand%d\b' % i] = self.reply
+
+def table_bot(size):
+    cls = type('TableBot%d' % size, (TableBot,), {'size': size})
+    return Harness(cls('bench@example.com', 'Bench', 'secret'))
+
+def dispatch(size):
+    def setup():
+        harness = table_bot(size)
+        # Hit the last command registered, and miss entirely.
+        bodies = ["command%d %d" % (size - 1, i) for i in range(size)] + \
+                 ["nothing here %d" % i for i in range(size)]
+        messages = [harness.message(body) for body in bodies]
+        state = {'i': 0}
+        def op():
+            i = state['i'] = (state['i'] + 1) % len(messages)
+            harness.deliver(messages[i])
+        return op
+    return setup
+
+for size in (10, 100, 1000):
+    benchmark('dispatch/%d-commands' % size)(dispatch(size))
+
+# ~~~~~~~ Dice
+
+def dice_bot(mode):
+    from quinoa.dicebot import DiceBot
+    bot = DiceBot('bench@example.com', 'Tyche', 'secret')
+    # Roll everything inline, so we time the dice rather than the pool.
+    bot.offload_dice = bot.max_dice
+    bot.default_mode = mode
+    return Harness(bot)
+
+# name, mode, roll arguments with %d for the number of dice
+ROLLS = [
+    ('owod', 'owod', "%d at 6 s"),
+    ('nwod', 'nwod', "%d 9 r"),
+    ('exalted', 'exalted', "%d"),
+    ('ork', 'orkworld', "%d"),
+    ('wushu', 'wushu', "%d over 4"),
+    ('shadowrun', 'shadowrun', "%d 0 s"),
+    ('h+e', 'h+e', "%d 3 2"),
+    ('generic', 'nwod', "%dd6 %dd10"),
+    ('expression', 'nwod', "%dd10!>=8 + 2d20kh1"),
+]
+# size, dice, calls per round
+POOLS = [('small', 5, 1000), ('huge', 10000, 10)]
+
+def roll(mode, args, dice):
+    def setup():
+        harness = dice_bot(mode)
+        message = harness.message("roll " + args.replace('%d', str(dice)))
+        return lambda: harness.deliver(message)
+    return setup
+
+for name, mode, args in ROLLS:
+    for size, dice, number in POOLS:
+        benchmark('roll/%s/%s' % (name, size), number)(
+                roll(mode, args, dice))
+
+# ~~~~~~~ Initiative and cards
+
+def initiative(mode, actors):
+    def setup():
+        harness = dice_bot(mode)
+        message = harness.message("init " + ' '.join(
+                "actor%d:%d" % (i, i % 12 + 1) for i in range(actors)))
+        return lambda: harness.deliver(message)
+    return setup
+
+for mode in ('owod', 'shadowrun'):
+    for actors in (10, 100):
+        benchmark('initiative/%s/%d' % (mode, actors), 100)(
+                initiative(mode, actors))
+
+@benchmark('cards/shuffle-deal-reveal-discard', 100)
+def cards():
+    harness = dice_bot('nwod')
+    bodies = ["shuffle", "deal me 5", "reveal my hand", "discard all",
+              "deal me 5", "discard all", "finish"]
+    messages = [harness.message(body) for body in bodies]
+    def op():
+        for message in messages:
+            harness.deliver(message)
+    return op
+
+# ~~~~~~~ Results
+
+def version():
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('quinoa').version
+    except Exception:
+        return 'dev'
+
+def previous(current):
+    """The newest results saved for a version before current, or None."""
+    if not os.path.isdir(RESULTS):
+        return None
+    versions = [f[:-len('.json')] for f in os.listdir(RESULTS)
+                if f.endswith('.json') and f != current + '.json']
+    if current != 'dev':
+        versions = [v for v in versions
+                    if v != 'dev' and LooseVersion(v) < LooseVersion(current)]
+    if not versions:
+        return None
+    with open(os.path.join(RESULTS, max(versions, key=LooseVersion) +
+                           '.json')) as f:
+        return json.load(f)
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-k", dest="pattern",
+            help="only run benchmarks whose names match this regex")
+    parser.add_option("--no-save", action="store_false", dest="save",
+            default=True, help="don't save the results")
+    parser.add_option("--rounds", type="int", default=5,
+            help="rounds per benchmark (default: 5)")
+    opts, args = parser.parse_args(argv)
+    current = version()
+    before = previous(current)
+    results = {}
+    regressions = []
+    for name, setup, number in BENCHMARKS:
+        if opts.pattern and not re.search(opts.pattern, name):
+            continue
+        seconds = measure(setup(), number, opts.rounds)
+        results[name] = seconds
+        line = "%-45s %10.1fus" % (name, seconds * 1e6)
+        old = before and before['results'].get(name)
+        if old:
+            change = seconds / old - 1
+            line += "  %+6.1f%% vs %s" % (change * 100, before['version'])
+            if change > THRESHOLD:
+                regressions.append(name)
+                line += "  REGRESSION"
+        print line
+    if opts.save:
+        if not os.path.isdir(RESULTS):
+            os.makedirs(RESULTS)
+        with open(os.path.join(RESULTS, current + '.json'), 'w') as f:
+            json.dump({'version': current,
+                       'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'results': results}, f, indent=2, sort_keys=True)
+    if regressions:
+        print "%d regression(s) over %d%%." % (len(regressions),
+                                                THRESHOLD * 100)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -17,15 +17,31 @@
 PATH=/usr/sbin:/usr/bin:/sbin:/bin
 DESC="Jabber bot"
 NAME=jabber-bot
-DAEMON=/usr/bin/python
-PYFILE=bot.py
-DAEMON_ARGS="${PYFILE}"
+DAEMON=/usr/local/bin/quinoa
+# The bot class to run, and its account.  The password is read from
+# $QUINOA_PASSWORD, which /etc/default/$NAME should set; keep that file
+# readable by root alone.  Every room to join, the bot's own included, goes
+# in $ROOMSFILE.
+BOTCLASS=quinoa.dicebot:DiceBot
+BOTJID=bot@example.com
+SHARDS=1
+ROOMSFILE=/etc/jabber-bot/rooms
+DAEMON_ARGS="--jid ${BOTJID} --shards ${SHARDS} --rooms-file ${ROOMSFILE} ${BOTCLASS}"
 PIDFILE=/var/run/$NAME.pid
 SCRIPTNAME=/etc/init.d/$NAME
 
+# Read configuration variable file if it is present
+[ -r /etc/default/$NAME ] && . /etc/default/$NAME
+# The daemon runs from /, so the database needs an absolute path.
+QUINOA_DB_URL=${QUINOA_DB_URL:-sqlite:////var/lib/quinoa/tyche.db}
+export QUINOA_PASSWORD QUINOA_DB_URL
+
 # Exit if the package is not installed
 [ -x "$DAEMON" ] || exit 0
-[ -e "$PYFILE" ] || exit 0
+[ -e "$ROOMSFILE" ] || exit 0
+
+# $DAEMON is a Python script, so the running process is the interpreter and
+# can't be matched with --exec; it's found by its pidfile alone.
 
 #
 # Function that starts the daemon/service
@@ -34,7 +50,7 @@ do_start()
 {
     start-stop-daemon --start --background --make-pidfile \
         --pidfile $PIDFILE --chuid jabberbot:jabberbot \
-        --exec $DAEMON $DAEMON_ARGS
+        --startas $DAEMON -- $DAEMON_ARGS
 }
 
 #
@@ -42,8 +58,8 @@ do_start()
 #
 do_stop()
 {
-    start-stop-daemon --stop --pidfile $PIDFILE \
-        --exec $DAEMON --retry 4
+    start-stop-daemon --stop --pidfile $PIDFILE --remove-pidfile \
+        --retry TERM/10/KILL/5
 }
 
 case "$1" in
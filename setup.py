@@ -18,6 +18,20 @@ This is a simple package for making MUC/groupchat-aware Jabber bots.  It provide
         '': 'src'
         },
     packages=find_packages('src'),
+    entry_points={
+        'console_scripts': [
+            'quinoa = quinoa.supervisor:main',
+            'quinoa-loadtest = quinoa.loadtest:main',
+            ],
+        'quinoa.commands': [
+            'shuffle = quinoa.cards:shuffle',
+            'deal = quinoa.cards:deal',
+            'reveal = quinoa.cards:reveal',
+            'peek = quinoa.cards:peek',
+            'discard = quinoa.cards:discard',
+            'finish = quinoa.cards:finish',
+            ],
+        },
     platforms='All',
     classifiers=[
           'Topic :: Communications :: Chat',
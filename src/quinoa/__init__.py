@@ -1 +1,2 @@
-from quinoa import Bot
+from quinoa import Bot, takes_match
+from pool import BotPool
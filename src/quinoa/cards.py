@@ -0,0 +1,121 @@
+"""
+A deck of cards for the dice bot, dealt per room.
+
+These are command plugins (see quinoa.plugins), offered under the
+quinoa.commands entry point group in setup.py, so a bot that calls
+load_plugins() gets them and this module isn't imported until someone
+shuffles.  Each takes the bot and the message, and keeps the deck and hands
+in bot.room(msg).
+"""
+
+from random import shuffle as _shuffle
+import xmppony as xmpp
+
+def shuffle(bot, msg):
+    """Usage:
+        shuffle
+    """
+    finish(bot, msg) # sloppy, but it needs a msg
+    room = bot.room(msg)
+    room.deck = []
+    room.players = {}
+    for suit in ('Hearts', 'Spades', 'Diamonds', 'Clubs'):
+        for value in (['Ace'] + map(str, range(2, 11)) +
+                      ['Jack', 'Queen', 'King']):
+            room.deck.append((value, suit))
+    _shuffle(room.deck)
+    return "%i-card deck ready." % len(room.deck)
+
+def deal(bot, msg):
+    """Usage:
+        deal me <number of cards>
+    """
+    room = bot.room(msg)
+    if not room.deck:
+        return
+    args = msg.getBody()
+    try:
+        cmd, me, number = args.split()
+        number = int(number)
+    except:
+        return "How many?"
+    if len(room.deck) < number:
+        return "Not enough cards; only %i left." % len(room.deck)
+    frm = str(msg.getFrom())
+    if frm not in room.players:
+        room.players[frm] = []
+    player = room.players[frm]
+    for i in range(number):
+        player.append(room.deck.pop())
+    ret = "%i cards dealt; %i left. Hand sizes are: " % (number,
+                                                         len(room.deck))
+    ret += ', '.join(["%s with %i" % (str(jid), len(hand)) for jid, hand in
+                                                room.players.iteritems()])
+    return ret
+
+def reveal(bot, msg):
+    """Usage:
+        reveal my hand
+    """
+    room = bot.room(msg)
+    if not room.deck:
+        return
+    if msg.getBody().lower() == "reveal my hand":
+        frm = str(msg.getFrom())
+        if frm in room.players:
+            hand = ', '.join("%s of %s" % x for x in room.players[frm])
+            return "%s has %s" % (str(frm), hand)
+    return
+
+def peek(bot, msg):
+    """Usage:
+        peek
+    """
+    room = bot.room(msg)
+    if not room.deck:
+        return
+    frm = str(msg.getFrom())
+    out_msg = xmpp.protocol.Message(to=frm, typ='chat')
+    out_msg.setBody(", ".join("%s of %s" % x for x in room.players[frm])
+                    or "No cards.")
+    bot.send(out_msg)
+    return "OK."
+
+def discard(bot, msg):
+    """Usage:
+        discard <value of suit>|all
+    """
+    room = bot.room(msg)
+    if not room.deck:
+        return
+    frm = str(msg.getFrom())
+    if frm in room.players:
+        try:
+            cmd, all = msg.getBody().split()
+            if all.lower() == 'all':
+                ret = ', '.join("%s of %s" % x for x in room.players[frm])
+                ret += " discarded."
+                room.players[frm] = []
+                return ret
+        except:
+            pass
+        try:
+            cmd, value, of, suit = msg.getBody().split()
+        except:
+            return
+        try:
+            room.players[frm].remove((value.title(), suit.title()))
+        except ValueError:
+            return "You never had that card to begin with."
+        return "Done. You've got %i cards left." % len(room.players[frm])
+
+def finish(bot, msg):
+    """Usage:
+        finish
+    """
+    room = bot.room(msg)
+    if not room.players and not room.deck:
+        return
+    room.players = None
+    room.deck = None
+    return "Deck and hands destroyed."
@@ -1,20 +1,24 @@
 #!/usr/bin/python
 # vim: set fileencoding=utf-8 :
 
+import os
 import re
 import shlex
 import time
+import itertools
+import threading
+import multiprocessing
 import xmppony as xmpp
-import sqlalchemy.ext.declarative
-import sqlalchemy.orm.exc
-import sqlalchemy.orm
-import sqlalchemy
 from optparse import OptionParser
 from collections import defaultdict
 from random import randint as rand
-from random import shuffle
 from math import ceil as ceiling
-from quinoa import Bot
+from quinoa import Bot, takes_match
+import vectordice
+import diceexpr
+import odds
+from rooms import RoomStore
+from scheduler import earliest
 
 # ~~~~~~~ Special Option Parsing
 
@@ -24,81 +28,10 @@ class JabberOptionParser(OptionParser):
     def error(self, *args, **kwargs):
         raise ValueError, "incorrect option or argument"
 
-# ~~~~~~~ DATABASE definition
-path = '/home/kit/Desktop/hg-repos/quinoa/'
-#path = ''
-engine = sqlalchemy.create_engine('sqlite:///%styche.db' % path)
-Session = sqlalchemy.orm.sessionmaker(bind=engine)
-
-Base = sqlalchemy.ext.declarative.declarative_base()
-class User(Base):
-    __tablename__ = 'users'
-    jid = sqlalchemy.Column(sqlalchemy.Unicode, primary_key=True)
-    batsignal = sqlalchemy.Column(sqlalchemy.Boolean)
-    points = sqlalchemy.Column(sqlalchemy.Integer, default=0)
-    def __init__(self, jid):
-        self.jid = jid
-        self.batsignal = True
-        self.points = 0
-    def __unicode__(self):
-        aliases = ' a.k.a. '.join(unicode(a) for a in self.aliases)
-        if not aliases:
-            aliases = 'No-name'
-        s = 's'
-        if self.points == 1 or self.points == -1:
-            s = ''
-        return "%s (%s), %d point%s" % (aliases, self.jid, self.points, s)
-    __str__ = __unicode__
-
-class JidAlias(Base):
-    __tablename__ = 'jid_aliases'
-    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
-    additional_jid = sqlalchemy.Column(sqlalchemy.Unicode)
-    primary_jid = sqlalchemy.Column(sqlalchemy.Unicode, \
-                             sqlalchemy.ForeignKey('users.jid'))
-    user = sqlalchemy.orm.relation(User, \
-            backref=sqlalchemy.orm.backref('jid_aliases', order_by=id))
-    def __init__(self, additional_jid):
-        self.additional_jid = additional_jid
-
-class Alias(Base):
-    __tablename__ = 'aliases'
-    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
-    user_jid = sqlalchemy.Column(sqlalchemy.Unicode, \
-                             sqlalchemy.ForeignKey('users.jid'))
-    name = sqlalchemy.Column(sqlalchemy.Unicode)
-    user = sqlalchemy.orm.relation(User, \
-            backref=sqlalchemy.orm.backref('aliases', order_by=id))
-    def __init__(self, name):
-        self.name = name
-    def __unicode__(self):
-        return self.name
-    __str__ = __unicode__
-
-class PendingConnection(Base):
-    __tablename__ = 'pending_connections'
-    primary_jid = sqlalchemy.Column(sqlalchemy.Unicode)
-    additional_jid = sqlalchemy.Column(sqlalchemy.Unicode, primary_key=True)
-    def __init__(self, primary_jid, additional_jid):
-        self.primary_jid = primary_jid
-        self.additional_jid = additional_jid
-    def process(self, msg):
-        if msg.getBody().strip('!').lower() == 'y':
-            ret = True
-            session = Session()
-            try:
-                user = session.query(User).filter_by(jid=self.primary_jid).one()
-            except sqlalchemy.orm.exc.NoResultFound:
-                return False
-            session.add(user)
-            user.jid_aliases.append(JidAlias(self.additional_jid))
-            session.commit()
-        else:
-            ret = False
-        return ret
+# Where the user database lives, unless DiceBot.db_url or $QUINOA_DB_URL say
+# otherwise.  It's absolute, so it doesn't move with the working directory.
+DEFAULT_DB_URL = 'sqlite:////var/lib/quinoa/tyche.db'
 
-Base.metadata.create_all(engine)
-# ~~~~~~~ END DATABASE
 
 def owod(dice, diff, spec=False, will=False):
     def norm_roll(dice):
@@ -373,22 +306,218 @@ def hande(heaven, earth, passing_grade=1):
 def generic(num, size):
     return ', '.join(map(str, (rand(1, size) for x in xrange(num))))
 
+def generic_pairs(pairs, roll=generic):
+    ret = []
+    for pair in pairs:
+        num, size = pair
+        if num == '':
+            num = 1
+        if size == 'F' or size == 'f':
+            try:
+                num = int(num)
+            except ValueError, e:
+                return "Bad number: %s" % e
+            ret.append(fudge(num))
+        try:
+            num = int(num)
+            size = int(size)
+        except ValueError, e:
+            return "Bad size: %s" % e
+        ret.append(roll(num, size))
+    return '; '.join(ret)
+
+def vector_generic_pairs(pairs):
+    return generic_pairs(pairs, vectordice.generic)
+
+# The NumPy versions of the roll functions, for big pools.
+VECTORIZED = {
+    owod: vectordice.owod,
+    nwod: vectordice.nwod,
+    exalted: vectordice.exalted,
+    ork: vectordice.ork,
+    wushu: vectordice.wushu,
+    shadowrun: vectordice.shadowrun,
+    generic_pairs: vector_generic_pairs,
+}
+
+# ~~~~~~~ Game systems
+
+class GameSystem(object):
+    """
+    A game the dice bot can roll for, set with "mode name".  Arguments to
+    roll that match pattern are turned into arguments for roller by parse,
+    which is given the match's groups; pool is the index of the number of
+    dice among them, a function of the roller's arguments giving it, or None
+    if there's no pool.  explode, if given, is
+    called with the roller's arguments and gives the chance that a die
+    explodes into another.  odds, if given, works out the chances of a roll
+    from the same arguments.  help says how to roll.
+    """
+    def __init__(self, name, pattern, roller, parse=None, pool=None,
+                 odds=None, help='', explode=None):
+        self.name = name
+        self.pattern = re.compile(pattern)
+        self.roller = roller
+        self.parse = parse
+        self.pool = pool
+        self.odds = odds
+        self.help = help
+        self.explode = explode
+    def match(self, args):
+        """The roller's arguments for args, or None if they don't fit."""
+        found = self.pattern.match(args)
+        if found is None:
+            return None
+        if self.parse is None:
+            return found.groups()
+        return self.parse(*found.groups())
+    def size(self, rolled):
+        """The size of the pool for the roller's arguments rolled."""
+        if self.pool is None:
+            return 0
+        if callable(self.pool):
+            return self.pool(*rolled)
+        return rolled[self.pool]
+    def dice(self, rolled):
+        """
+        How many dice a roll with the roller's arguments rolled can be
+        expected to throw, explosions and all.  Raises ValueError if it would
+        never stop.
+        """
+        size = self.size(rolled)
+        if not size or self.explode is None:
+            return size
+        chance = self.explode(*rolled)
+        if chance >= 1:
+            raise ValueError("Every die would explode forever.")
+        return int(ceiling(size / (1 - chance)))
+    def __repr__(self):
+        return "<GameSystem %s>" % self.name
+
+SYSTEMS = {} # mode name -> GameSystem
+
+def register_system(system):
+    """Make system available as a mode, in place of any of the same name."""
+    SYSTEMS[system.name] = system
+    return system
+
+register_system(GameSystem('owod', r'^(\d+) at (\d+)( s)?( w)?$', owod,
+        lambda dice, diff, spec, will: (int(dice), int(diff), spec, will),
+        pool=0, odds=odds.owod,
+        explode=lambda dice, diff, spec, will: 0.1 if spec else 0,
+        help="""oWoD: roll # at # (s) (w)
+    pool size, difficulty, (specialized?) (willpower spent?)"""))
+register_system(GameSystem('nwod', r'^(\d+)( \d+)?( r)?$', nwod,
+        lambda dice, again, rote: (int(dice), int(again or 10), rote),
+        pool=0, odds=odds.nwod,
+        explode=lambda dice, again, rote: max(0, (11 - again) / 10.),
+        help="""nWoD: roll # (#) (r)
+    pool size, (roll again threshold?), (rote?)"""))
+register_system(GameSystem('exalted', r'^(\d+)$', exalted,
+        lambda dice: (int(dice),), pool=0, odds=odds.exalted,
+        help="""Exalted: roll #
+    pool size"""))
+register_system(GameSystem('btvs', r'^(\d+)$', btvs,
+        lambda skill: (int(skill),), help="""Buffy the Vampire Slayer: roll #
+    skill"""))
+register_system(GameSystem('allflesh', r'^(\d+)$', allflesh,
+        lambda skill: (int(skill),), help="""All Flesh Must Be Eaten: roll #
+    skill"""))
+register_system(GameSystem('qin', r'^$', qin, help="Qin: roll"))
+register_system(GameSystem('l5r', r'^(\d+)k(\d+) (\d+)( u)?( e)?$', l5r,
+        lambda pool, adds, target, unskilled, emphasized:
+            (int(pool), int(adds), int(target), unskilled, emphasized),
+        pool=0, help="""Legend of the 5 Rings: roll #k# # (u) (e)
+    pool, adds, target number, unskilled, emphasized"""))
+register_system(GameSystem('orkworld', r'^(\d+)$', ork,
+        lambda dice: (int(dice),), pool=0, help="""Orkworld: roll #
+    pool size"""))
+register_system(GameSystem('wushu', r'^(\d+) over (\d+)$', wushu,
+        lambda dice, trait: (int(dice), int(trait)), pool=0,
+        help="""Wushu: roll # over #
+    pool size, trait"""))
+register_system(GameSystem('alternity', r'^(\d+), (-?\d+)$', alternity,
+        lambda skill, situation: (int(skill), int(situation)),
+        help="""Alternity: roll #, (-)#
+    skill, (negative) step modifier"""))
+register_system(GameSystem('innomine', r'^(\d+)$', in_nomine,
+        lambda skill: (int(skill),), help="""In Nomine: roll #
+    skill"""))
+register_system(GameSystem('pendragon', r'^(\d+) (-?\d+)$', pendragon,
+        lambda skill, modifiers: (int(skill), int(modifiers)),
+        help="""Pendragon: roll # (-)#
+    skill, modifiers"""))
+register_system(GameSystem('shadowrun', r'^(\d+)( \d+)?( s)?$', shadowrun,
+        lambda pool, leftover, ro6: (int(pool), int(leftover or 0), ro6),
+        pool=lambda pool, leftover, ro6: pool + leftover, odds=odds.shadowrun,
+        explode=lambda pool, leftover, ro6: 1 / 6. if ro6 else 0,
+        help="""Shadowrun: roll # (#) (s)
+    pool, successes from the last roll, (rule of six?)"""))
+register_system(GameSystem('h+e', r'^(\d+) (-?\d+)( \d+)?$', hande,
+        lambda heaven, earth, passing_grade:
+            (int(heaven), int(earth), int(passing_grade or 1)),
+        pool=0, help="""Heaven and Earth: roll # (-)# (#)
+    heaven, earth, passing grade"""))
+
+# Plain #d# rolls, with no arithmetic or modifiers, are rolled as they always
+# have been; anything more (Fudge dice included) is a dice expression.
+_generic = re.compile(r'(\d*)d(\d+|F|f)')
+_pairs = re.compile(r'^(\s*\d*d\d+)+$')
+_rick = re.compile(r'rick')
+
+class Room(object):
+    """The game in one room: its mode, and the deck and hands, if dealt."""
+    def __init__(self, mode):
+        self.mode = mode
+        self.deck = None
+        self.players = None # JID -> hand
+
 class DiceBot(Bot):
+    # Rolls of more than offload_dice dice go to a pool of roll_processes
+    # processes, and are given up on after roll_timeout seconds.  Rolls of
+    # more than max_dice dice are refused.
+    offload_dice = 1000
+    max_dice = 100000
+    roll_processes = 2
+    roll_timeout = 10
+    # Rolls of more than vector_dice dice are made with NumPy, if it's
+    # installed; it only pays off for big pools.
+    vector_dice = 100
+    # The most dice the odds command will work out the chances of.
+    max_odds_dice = 100
+    # Each room has its own mode, deck and hands, starting in default_mode.
+    # Rooms that go quiet for room_ttl seconds lose theirs, and past
+    # max_rooms rooms the least recently used one does.
+    default_mode = 'nwod'
+    room_ttl = 6 * 60 * 60
+    max_rooms = 1000
+    # SQLAlchemy URL of the user database; see DEFAULT_DB_URL.  Nothing is
+    # imported or connected until a command needs it.
+    db_url = None
     def __init__(self, *args, **kwargs):
+        db_url = kwargs.pop('db_url', None)
         Bot.__init__(self, *args, **kwargs)
-        self.mode = 'nwod'
-        self.deck = None
-        self.players = None
-    def on_connect(self):
-        join = xmpp.protocol.Message()
-        join.setBody('join ooc@rooms.transneptune.net')
-        self.join(join)
+        if db_url is not None:
+            self.db_url = db_url
+        # Run by quinoa, each shard is given its share of the rooms file in
+        # place of this.
+        self.autojoin = ['ooc@rooms.transneptune.net']
+        # Not self.rooms, which is the rooms we're in and our nick there.
+        self.games = RoomStore(lambda: Room(self.default_mode),
+                               self.room_ttl, self.max_rooms)
+        self._pool = None
+        # Commands may run on several threads at once; this keeps them from
+        # each starting a pool.
+        self._pool_lock = threading.Lock()
+        self._rolls = {} # token -> (msg, pool) for rolls in the pool
+        self._roll_tokens = itertools.count()
     def register_commands(self):
         #self.commands[r'%s' % '|'.join(SOUND_EFFECTS)] = self.sound_effects
         #self.commands[r'(?i)%s' % '|'.join(MEMES)] = self.meme
         # Dice tasks
         self.commands[r'[Mm]ode\b'] = self.mode
         self.commands[r'[Rr]oll\b'] = self.roll
+        self.commands[r'[Oo]dds\b'] = self.odds
         self.commands[r'[Ii]nit\b'] = self.initiative
         # User management tasks
         self.commands[r'[Aa]ccount\b'] = self.remember_me
@@ -396,109 +525,25 @@ class DiceBot(Bot):
         self.commands[r'(?i)batsignal\??$'] = self.batsignal
         self.commands[r'!\b'] = self.confirm_user
         self.commands[r'[Gg]ive\b'] = self.points
-        # Deck of cards tasks
-        self.commands[r'[Ss]huffle\b'] = self.cards_shuffle
-        self.commands[r'[Dd]eal\b'] = self.cards_deal
-        self.commands[r'[Rr]eveal\b'] = self.cards_show
-        self.commands[r'[Pp]eek\b'] = self.cards_peek
-        self.commands[r'[Dd]iscard\b'] = self.cards_discard
-        self.commands[r'[Ff]inish\b'] = self.cards_finish
-    def cards_shuffle(self, msg):
-        """Usage:
-            shuffle
-        """
-        self.cards_finish(msg) # sloppy, but it needs a msg
-        self.deck = []
-        self.players = {}
-        for suit in ('Hearts', 'Spades', 'Diamonds', 'Clubs'):
-            for value in ['Ace'] + map(str, range(2, 11)) + ['Jack', 'Queen', 'King']:
-                self.deck.append((value, suit))
-        shuffle(self.deck)
-        return "%i-card deck ready." % len(self.deck)
-    def cards_deal(self, msg):
-        """Usage:
-            deal me <number of cards>
-        """
-        if not self.deck:
-            return
-        args = msg.getBody()
-        try:
-            cmd, me, number = args.split()
-            number = int(number)
-        except:
-            return "How many?"
-        if len(self.deck) < number:
-            return "Not enough cards; only %i left." % len(self.deck)
-        frm = str(msg.getFrom())
-        if frm not in self.players:
-            self.players[frm] = []
-        player = self.players[frm]
-        for i in range(number):
-            player.append(self.deck.pop())
-        ret = "%i cards dealt; %i left. Hand sizes are: " % (number,
-                                                             len(self.deck))
-        ret += ', '.join(["%s with %i" % (str(jid), len(hand)) for jid, hand in
-                                                    self.players.iteritems()])
-        return ret
-    def cards_show(self, msg):
-        """Usage:
-            reveal my hand
+        # Deck of cards tasks, from quinoa.cards, and any other installed
+        # command packs.
+        self.load_plugins()
+    def _db(self):
         """
-        if not self.deck:
-            return
-        if msg.getBody().lower() == "reveal my hand":
-            frm = str(msg.getFrom())
-            if frm in self.players:
-                hand = ', '.join("%s of %s" % x for x in self.players[frm])
-                return "%s has %s" % (str(frm), hand)
-        return
-    def cards_peek(self, msg):
-        """Usage:
-            peek
+        The models module and a new session, loading SQLAlchemy and setting
+        up the database the first time.
         """
-        if not self.deck:
-            return
-        frm = str(msg.getFrom())
-        out_msg = xmpp.protocol.Message(to=frm, typ='chat')
-        out_msg.setBody(", ".join("%s of %s" % x for x in self.players[frm])
-                        or "No cards.")
-        self.conn.send(out_msg)
-        return "OK."
-    def cards_discard(self, msg):
-        """Usage:
-            discard <value of suit>|all
+        import models
+        url = self.db_url or os.environ.get('QUINOA_DB_URL', DEFAULT_DB_URL)
+        return models, models.connect(url)()
+    def room(self, msg):
         """
-        if not self.deck:
-            return
-        frm = str(msg.getFrom())
-        if frm in self.players:
-            try:
-                cmd, all = msg.getBody().split()
-                if all.lower() == 'all':
-                    ret = ', '.join("%s of %s" % x for x in self.players[frm])
-                    ret += " discarded."
-                    self.players[frm] = []
-                    return ret
-            except:
-                pass
-            try:
-                cmd, value, of, suit = msg.getBody().split()
-            except:
-                return
-            try:
-                self.players[frm].remove((value.title(), suit.title()))
-            except ValueError:
-                return "You never had that card to begin with."
-            return "Done. You've got %i cards left." % len(self.players[frm])
-    def cards_finish(self, msg):
-        """Usage:
-            finish
+        The state of the game in the room msg came from, or with the person
+        who sent it, if it's a private chat.
         """
-        if not self.players and not self.deck:
-            return
-        self.players = None
-        self.deck = None
-        return "Deck and hands destroyed."
+        return self.games.get(msg.getFrom().getStripped())
+    def periodic_action(self):
+        self.games.sweep()
     def points(self, msg):
         """Give points to someone on the batsignal.  Usage: give USER X points"""
         args = msg.getBody()
@@ -507,10 +552,11 @@ class DiceBot(Bot):
             number = int(number)
         except:
             return
-        session = Session()
+        models, session = self._db()
         try:
-            user = session.query(Alias).filter(Alias.name.like(un)).one()
-        except sqlalchemy.orm.exc.NoResultFound:
+            user = session.query(models.Alias) \
+                    .filter(models.Alias.name.like(un)).one()
+        except models.NoResultFound:
             return "Who's that?"
         user = user.user
         session.add(user)
@@ -544,18 +590,18 @@ class DiceBot(Bot):
         # and do a special call to self.send, to alert the other JID to reply
         # with a confirmation or denial.  Then, return with a note about the
         # behavior to expect.
-        session = Session()
+        models, session = self._db()
         try:
-            user = session.query(User).filter_by(jid=account).one()
-        except sqlalchemy.orm.exc.NoResultFound:
-            user = User(account)
+            user = session.query(models.User).filter_by(jid=account).one()
+        except models.NoResultFound:
+            user = models.User(account)
         session.add(user)
         if opts.quiet:
             user.batsignal = False
         else:
             user.batsignal = True
         if args and not opts.jid:
-            user.aliases = [Alias(x) for x in args]
+            user.aliases = [models.Alias(x) for x in args]
             ret = unicode(user)
         if args and opts.jid:
             confirm_msg = "%s claims you are another Jabber identity of " \
@@ -566,27 +612,26 @@ class DiceBot(Bot):
             from_.setResource('')
             for jid in args:
                 try:
-                    pend = session.query(PendingConnection) \
+                    pend = session.query(models.PendingConnection) \
                         .filter_by(additional_jid=jid).one()
                 except:
-                    pend = PendingConnection(unicode(from_), jid)
+                    pend = models.PendingConnection(unicode(from_), jid)
                 session.add(pend)
                 self._send(jid, confirm_msg, 'chat')
             ret = "Message sent to other identity."
         session.commit()
         return ret
-    def who_is(self, msg):
+    @takes_match
+    def who_is(self, msg, match):
         """Ask who someone is, by alias or email."""
-        args = msg.getBody().strip().rstrip('?').strip()
-        try:
-            who, is_, args = args.split(None, 2)
-        except:
+        args = self._args(msg, match).rstrip('?').strip()
+        if not args:
             return
-        session = Session()
+        models, session = self._db()
         ret = []
         if args.lower() == "john galt":
             return "Fuck Ayn Rand."
-        for v in session.query(User).all():
+        for v in session.query(models.User).all():
             if args.lower() == v.jid.lower():
                 ret.append(v)
             if args.lower() in (x.name.lower() for x in v.aliases):
@@ -599,16 +644,16 @@ class DiceBot(Bot):
         """Call for the troops!"""
         if msg.getType() != 'groupchat':
             return "Only use this from a Jabber room."
-        session = Session()
+        models, session = self._db()
         if msg.getBody().endswith("?"):
             ret = []
-            for u in session.query(User).all():
+            for u in session.query(models.User).all():
                 if u.batsignal:
                     ret.append(u)
             return '\n'.join(unicode(x) for x in ret)
         room = msg.getFrom()
         room.setResource('')
-        for u in session.query(User).all():
+        for u in session.query(models.User).all():
             if u.batsignal:
                 self.invite(room, xmpp.protocol.JID(u.jid))
     def user_in_room(self, room, jid):
@@ -627,22 +672,22 @@ class DiceBot(Bot):
                                     'jid': room,
                                    })
         msg.addChild(node=body)
-        self.conn.send(msg)
+        self.send(msg)
     def confirm_user(self, msg):
         """Creates a new user connection, or destroys a pending one, based on
         input."""
         additional = msg.getFrom()
         additional.setResource('')
         additional = unicode(additional)
-        session = Session()
+        models, session = self._db()
         try:
-            pending = session.query(PendingConnection) \
+            pending = session.query(models.PendingConnection) \
                     .filter_by(additional_jid=additional).first()
         except KeyError:
             return "Sorry, something went wrong.  " \
                    "Please contact kit@transneptune.net"
         try:
-            approved = pending.process(msg)
+            approved = pending.process(msg, session)
         except:
             return "Are you IMing me from the right account?"
         session.delete(pending)
@@ -650,251 +695,155 @@ class DiceBot(Bot):
         if approved:
             return "Thank you!"
         return "Sorry to trouble you."
-    def mode(self, msg):
-        """Set or view the bot's current game mode.
+    @takes_match
+    def mode(self, msg, match):
+        """Set or view the game mode in this room.
             * mode
                 shows current mode
             * mode list
                 shows possible modes
+            * mode help (<value>)
+                shows how to roll in the current mode, or in <value>
             * mode <value>
                 if <value> in possible modes, sets mode to that value."""
-        modes = set([
-                "owod",
-                "nwod",
-                "exalted",
-                "btvs",
-                "allflesh",
-                "qin",
-                "orkworld",
-                "l5r",
-                "wushu",
-                "alternity",
-                "innomine",
-                "pendragon",
-                "shadowrun",
-                "h+e"
-                ])
-        args = msg.getBody()
-        try:
-            cmd, args = args.split(None, 1)
-        except:
-            return self.mode
+        args = self._args(msg, match)
+        room = self.room(msg)
+        if not args:
+            return room.mode
         if args == 'list':
-            return ', '.join(sorted(modes))
-        if args in modes:
-            self.mode = args
+            return ', '.join(sorted(SYSTEMS))
+        if args.split()[0] == 'help':
+            system = SYSTEMS.get(args[4:].strip() or room.mode)
+            if system is None:
+                return "No such mode."
+            return system.help
+        if args in SYSTEMS:
+            room.mode = args
             return "Mode set: %s" % args
         return "No such mode."
-    def roll(self, msg):
-        """There are a number of ways to roll dice.  In all cases, replace # with one or more numerals, and all elements in parentheses are optional:
-            * oWoD: roll # at # (s) (w)
-                pool size, difficulty, (specialized?) (willpower spent?)
-            * nWoD: roll # (#) (r)
-                pool size, (roll again threshold?), (rote?)
-            * Exalted: roll #
-                pool size
-            * Buffy the Vampire Slayer: roll #
-                skill
-            * All Flesh Must Be Eaten: roll #
-                skill
-            * Qin: roll
-            * Legend of the 5 Rings: #k# # (u) (e)
-                pool, adds, target number, unskilled, emphasized
-            * Orkworld: roll #
-                pool size
-            * Wushu: roll # over #
-                pool size, trait
-            * Alternity: roll #, (-)#
-                skill, (negative) step modifier
-            * In Nomine: roll #
-                skill
-            * Pendragon: roll # (-)#
-                skill, modifiers
-            * Shadowrun: roll # (#) (s)
-                pool, successes from the last roll, (rule of six?)
-            * Heaven and Earth: roll # (-)# (#)
-                heaven, earth, passing grade
+    @takes_match
+    def roll(self, msg, match):
+        """Roll dice for the current game mode; 'mode help' says how, and 'mode list' shows the other modes.  In any mode, replace # with one or more numerals:
             * Generic Dice: roll #d#
-                number, size (size may be F for Fudge dice)"""
-        args = msg.getBody()
-        try:
-            command, args = args.split(None, 1)
-        except:
-            pass
-        _generic = re.compile(r'(\d*)d(\d+|F|f)')
-        _rick = re.compile(r'rick')
-        if self.mode == "owod":
-            _owod = re.compile(r'^(\d+) at (\d+)( s)?( w)?$')
-            if _owod.search(args):
-                dice, diff, spec, will = _owod.search(args).groups()
-                try:
-                    dice = int(dice)
-                    diff = int(diff)
-                except ValueError, e:
-                    return "Bad value: %s" % e
-                return owod(dice, diff, spec, will)
-        if self.mode == "nwod":
-            _nwod = re.compile(r'^(\d+)( \d+)?( r)?$')
-            if _nwod.search(args):
-                dice, again, rote = _nwod.search(args).groups()
-                try:
-                    dice = int(dice)
-                except ValueError, e:
-                    return "Bad value: %s" % e
-                try:
-                    again = int(again.strip())
-                except ValueError, e:
-                    again = 10
-                except AttributeError, e:
-                    again = 10
-                return nwod(dice, again, rote)
-        if self.mode == "exalted":
-            _exalted = re.compile(r'^(\d+)$')
-            if _exalted.search(args):
-                dice, = _exalted.search(args).groups()
-                try:
-                    dice = int(dice)
-                except ValueError, e:
-                    return "Bad value: %s" % e
-                return exalted(dice)
-        if self.mode == "btvs":
-            _btvs = re.compile(r'^(\d+)$')
-            if _btvs.search(args):
-                skill, = _btvs.search(args).groups()
-                try:
-                    skill = int(skill)
-                except ValueError, e:
-                    return "Bad value: %s" % e
-                return btvs(skill)
-        if self.mode == "allflesh":
-            _allflesh = re.compile(r'^(\d+)$')
-            if _allflesh.search(args):
-                skill, = _allflesh.search(args).groups()
-                try:
-                    skill = int(skill)
-                except ValueError, e:
-                    return "Bad value: %s" % e
-                return allflesh(skill)
-        if self.mode == "qin":
-            _qin = re.compile(r'^$')
-            if _qin.search(args):
-                return qin()
-        if self.mode == "l5r":
-            _l5r = re.compile(r'^(\d+)k(\d+) (\d+)( u)?( e)?$')
-            if _l5r.search(args):
-                pool, adds, target, unskilled, emphasized = \
-                                                _l5r.search(args).groups()
-                try:
-                    pool = int(pool)
-                    adds = int(adds)
-                    target = int(target)
-                except ValueError, e:
-                    return "Bad value: %s" % e
-                return l5r(pool, adds, target, unskilled, emphasized)
-        if self.mode == "ork":
-            _ork = re.compile(r'^(\d+)$')
-            if _ork.search(args):
-                dice, = _ork.search(args).groups()
-                try:
-                    dice = int(dice)
-                except ValueError, e:
-                    return "Bad value: %s" % e
-                return ork(int(dice))
-        if self.mode == "wushu":
-            _wushu = re.compile(r'^(\d+) over (\d+)$')
-            if _wushu.search(args):
-                dice, trait = _wushu.search(args).groups()
-                try:
-                    dice = int(dice)
-                    trait = int(dice)
-                except ValueError, e:
-                    return "Bad value: %s" % e
-                return wushu(dice, trait)
-        if self.mode == "alternity":
-            _alternity = re.compile(r'^(\d+), (-?\d+)$')
-            if _alternity.search(args):
-                skill, situation = _alternity.search(args).groups()
-                try:
-                    skill = int(skill)
-                    situation = int(situation)
-                except ValueError, e:
-                    return "Bad value: %s" % e
-                return alternity(skill, situation)
-        if self.mode == "innomine":
-            _in_nomine = re.compile(r'^(\d+)$')
-            if _in_nomine.search(args):
-                skill, = _in_nomine.search(args).groups()
-                try:
-                    skill = int(skill)
-                except ValueError, e:
-                    return "Bad value: %s" % e
-                return in_nomine(skill)
-        if self.mode == "pendragon":
-            _pendragon = re.compile(r'^(\d+) (-?\d+)$')
-            if _pendragon.search(args):
-                skill, modifiers = _pendragon.search(args).groups()
-                try:
-                    skill = int(skill)
-                    modifiers = int(modifiers)
-                except ValueError, e:
-                    return "Bad value: %s" % e
-                return pendragon(skill, modifiers)
-        if self.mode == "shadowrun":
-            _shadowrun = re.compile(r'^(\d+)( \d+)?( s)?$')
-            if _shadowrun.search(args):
-                pool, leftover, ro6 = _shadowrun.search(args).groups()
-                try:
-                    pool = int(pool)
-                    if leftover:
-                        leftover = int(leftover.strip())
-                    else:
-                        leftover = 0
-                except ValueError, e:
-                    return "Bad value: %s" % e
-                return shadowrun(pool, leftover, ro6)
-        if self.mode == "h+e":
-            _hande = re.compile(r'^(\d+) (-?\d+)( \d+)?$')
-            if _hande.search(args):
-                heaven, earth, passing_grade = _hande.search(args).groups()
+                number, size
+            * Dice expressions: roll 4d6kh3+2, 10d10!>=8, 2d20kl1, 3dF
+                keep/drop highest/lowest (kh, kl, dh, dl), explode (!),
+                reroll (r), count successes (>=), and arithmetic"""
+        args = self._args(msg, match)
+        mode = self.room(msg).mode
+        system = SYSTEMS.get(mode)
+        if system is not None:
+            try:
+                rolled = system.match(args)
+            except ValueError, e:
+                return "Bad value: %s" % e
+            if rolled is not None:
                 try:
-                    heaven = int(heaven)
-                    earth = int(earth)
-                    if passing_grade:
-                        passing_grade = int(passing_grade)
-                    else:
-                        passing_grade = 1
+                    dice = system.dice(rolled)
                 except ValueError, e:
-                    return "Bad value: %s" % e
-                return hande(heaven, earth, passing_grade)
+                    return str(e)
+                return self._dice(msg, dice, system.roller, *rolled)
+        if not _pairs.match(args):
+            try:
+                expression = diceexpr.compile(args)
+            except diceexpr.TooComplex, e:
+                return str(e)
+            except diceexpr.ParseError:
+                pass
+            else:
+                return self._dice(msg, expression.dice, diceexpr.roll, args)
         if _generic.search(args):
-            ret = []
-            for pair in _generic.findall(args):
-                num, size = pair
-                if num == '':
-                    num = 1
-                if size == 'F' or size == 'f':
-                    try:
-                        num = int(num)
-                    except ValueError, e:
-                        return "Bad number: %s" % e
-                    ret.append(fudge(num))
-                try:
-                    num = int(num)
-                    size = int(size)
-                except ValueError, e:
-                    return "Bad size: %s" % e
-                ret.append(generic(num, size))
-            return '; '.join(ret)
+            pairs = _generic.findall(args)
+            dice = sum(int(num or 1) for num, size in pairs)
+            return self._dice(msg, dice, generic_pairs, pairs)
         if _rick.search(args):
             time.sleep(rand(1, 3))
             return "http://is.gd/czLKl"
-    def initiative(self, msg):
+    def _dice(self, msg, dice, fn, *args):
+        """
+        Return fn(*args) for a roll of about dice dice.  Big rolls are sent to
+        the process pool instead, and their result is sent on when it's ready.
+        """
+        if dice > self.max_dice:
+            return "Too many dice; the most I'll roll is %d." % self.max_dice
+        if dice > self.vector_dice and vectordice.available:
+            fn = VECTORIZED.get(fn, fn)
+        if dice <= self.offload_dice:
+            return fn(*args)
+        token = next(self._roll_tokens)
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self.roll_processes)
+            self._rolls[token] = (msg, self._pool)
+            self._pool.apply_async(fn, args,
+                    callback=lambda ret: self.__rolled(token, ret))
+        self.schedule_in(self.roll_timeout, self.__roll_expired, token)
+    def __rolled(self, token, ret):
+        roll = self._rolls.get(token)
+        if roll is None:
+            return
+        # Queue the reply before forgetting the roll, so timeout() keeps
+        # polling until it's in the outbox.
+        if ret:
+            msg = roll[0]
+            self._send(msg.getFrom(), ret, msg.getType())
+        self._rolls.pop(token, None)
+    def timeout(self):
+        # Rolls in the pool answer from its own thread, which can't wake the
+        # serve loop, so poll while any are out.
+        timeout = Bot.timeout(self)
+        if self._rolls:
+            timeout = earliest(timeout, self.busy_poll_interval)
+        return timeout
+    def __roll_expired(self, token):
+        roll = self._rolls.pop(token, None)
+        if roll is None:
+            return
+        msg, pool = roll
+        self._send(msg.getFrom(), "That roll took too long.", msg.getType())
+        # The only way to stop the roll is to stop its process, and with it
+        # anything else running in the pool.
+        with self._pool_lock:
+            if pool is self._pool:
+                self._pool = None
+        pool.terminate()
+        for token, (msg, p) in self._rolls.items():
+            if p is pool and self._rolls.pop(token, None):
+                self._send(msg.getFrom(), "Sorry, that roll was lost.",
+                           msg.getType())
+    @takes_match
+    def odds(self, msg, match):
+        """Usage:
+            odds <roll>
+        gives the chances of a roll, made as you would with roll, in oWoD, nWoD, Exalted or Shadowrun mode."""
+        args = self._args(msg, match)
+        mode = self.room(msg).mode
+        system = SYSTEMS.get(mode)
+        if system is None or system.odds is None:
+            return "I can't work out odds in %s mode." % mode
+        try:
+            rolled = system.match(args)
+        except ValueError, e:
+            return "Bad value: %s" % e
+        if rolled is None:
+            return "I can't work out the odds of that in %s mode." % mode
+        # Checked before asking, so refused rolls never reach odds' cache.
+        # For Shadowrun the size counts the leftover hits too.
+        if system.size(rolled) > self.max_odds_dice:
+            return "Too many dice; the most I'll work out odds for is %d." % \
+                    self.max_odds_dice
+        try:
+            return str(system.odds(*rolled))
+        except ValueError, e:
+            return str(e)
+    @takes_match
+    def initiative(self, msg, match):
         """Roll initiative.
         * oWoD: init (name:value)*
         * Shadowrun: init (name:value)*"""
-        args = msg.getBody()
-        command, args = args.split(None, 1)
-        if self.mode == "owod":
+        args = self._args(msg, match)
+        mode = self.room(msg).mode
+        if mode == "owod":
             _owod = re.compile(r'^(\w+:\d+)( \w+:\d+)*$')
             if _owod.search(args):
                 actors = {}
@@ -908,7 +857,7 @@ class DiceBot(Bot):
                         (x[0], x[1][0], x[1][1]), \
                         reversed(sorted(actors.items(), \
                                  key=lambda (k, v): (v, k)))))
-        if self.mode == "shadowrun":
+        if mode == "shadowrun":
             _shadowrun = re.compile(r'^(\w+:\d+)( \w+:\d+)*$')
             def shadowrun_sort(a, b):
                 a, a2 = a
@@ -0,0 +1,350 @@
+"""
+Dice expressions, like 4d6kh3+2, 10d10!>=8, 3dF or 2d20kl1.
+
+    expression := term (("+" | "-") term)*
+    term       := factor (("*" | "/") factor)*
+    factor     := "-" factor | "(" expression ")" | number | dice
+    dice       := [number] "d" (number | "F" | "%") modifier* [target]
+    modifier   := ("kh" | "k" | "kl" | "dh" | "dl") [number]
+                | "!" [number]
+                | "r" [compare] number
+    target     := compare number
+    compare    := ">=" | "<=" | ">" | "<" | "="
+
+kh/k and kl keep the highest or lowest dice (one, if no number is given),
+and dh and dl drop them.  ! rolls another die for each that comes up at
+least number (the highest face if no number is given), and so on for the
+new ones.  r rerolls each die that matches once; r1 rerolls ones, r<8
+anything under eight.  A target counts the dice that meet it instead of
+adding them up.  Rerolls come first, then explosions, then keeping and
+dropping, whatever order they're written in.
+
+An expression is parsed into a tree, which is compiled into closures that
+do the rolling.  A roll that explodes into more than MAX_DICE dice is
+stopped there.  Expressions of more than MAX_TOKENS tokens, or nested more
+than MAX_DEPTH deep, are refused, as the tree is parsed, compiled and rolled
+by recursion.  Compiled expressions are kept in an LRUCache by their
+text, so one that's rolled again and again is only parsed once.
+"""
+
+import re
+import operator
+from math import ceil
+from random import randint as rand
+from lru import LRUCache
+
+cache = LRUCache(256)
+
+# Exploding dice stop here, however unlucky the roll.
+MAX_DICE = 1000000
+# The longest expression, in tokens, and the most parentheses and minus
+# signs one may nest.
+MAX_TOKENS = 500
+MAX_DEPTH = 32
+
+class ParseError(ValueError):
+    pass
+
+class TooComplex(ParseError):
+    """An expression too long or too deeply nested to parse."""
+
+class TooManyDice(Exception):
+    pass
+
+COMPARISONS = {
+    '>=': operator.ge,
+    '<=': operator.le,
+    '>': operator.gt,
+    '<': operator.lt,
+    '=': operator.eq,
+}
+
+OPERATORS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.floordiv,
+}
+
+_token = re.compile(r'\s*(\d+|kh|kl|dh|dl|[<>]=?|[dkrf%!()+*/=-])', re.I)
+
+def tokenize(text):
+    tokens = []
+    text = text.strip()
+    pos = 0
+    while pos < len(text):
+        match = _token.match(text, pos)
+        if not match:
+            raise ParseError("I don't understand %s" % text[pos:])
+        token = match.group(1).lower()
+        if token.isdigit():
+            token = int(token)
+        tokens.append(token)
+        pos = match.end()
+    return tokens
+
+# ~~~~~~~ The tree
+
+class Number(object):
+    dice = 0
+    def __init__(self, value):
+        self.value = value
+    def compile(self):
+        ret = (self.value, str(self.value))
+        return lambda: ret
+
+class Negative(object):
+    def __init__(self, operand):
+        self.operand = operand
+        self.dice = operand.dice
+    def compile(self):
+        operand = self.operand.compile()
+        def run():
+            value, shown = operand()
+            return -value, "-" + shown
+        return run
+
+class Group(object):
+    def __init__(self, inner):
+        self.inner = inner
+        self.dice = inner.dice
+    def compile(self):
+        inner = self.inner.compile()
+        def run():
+            value, shown = inner()
+            return value, "(%s)" % shown
+        return run
+
+class BinaryOp(object):
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+        self.dice = left.dice + right.dice
+    def compile(self):
+        op = OPERATORS[self.op]
+        left = self.left.compile()
+        right = self.right.compile()
+        template = "%%s %s %%s" % self.op
+        def run():
+            a, a_shown = left()
+            b, b_shown = right()
+            return op(a, b), template % (a_shown, b_shown)
+        return run
+
+def _keeper(kind, n):
+    """A function that marks dice as dropped for a keep or drop of n."""
+    def keep(rolls, kept):
+        order = sorted((i for i, k in enumerate(kept) if k),
+                       key=lambda i: rolls[i])
+        if kind == 'kh':
+            drop = order[:max(len(order) - n, 0)]
+        elif kind == 'kl':
+            drop = order[n:]
+        elif kind == 'dh':
+            drop = order[max(len(order) - n, 0):]
+        else:
+            drop = order[:n]
+        for i in drop:
+            kept[i] = False
+    return keep
+
+class Dice(object):
+    """
+    count dice from low to high, with any reroll, explode and keeps (as
+    (kind, n)), and a target as (comparison, n).
+    """
+    def __init__(self, count, low, high):
+        self.count = count
+        self.low = low
+        self.high = high
+        self.reroll = None
+        self.explode = None
+        self.keeps = []
+        self.target = None
+    @property
+    def dice(self):
+        """How many dice this can be expected to roll, explosions and all."""
+        if self.explode is None:
+            return self.count
+        faces = self.high - self.low + 1
+        chance = max(self.high - self.explode + 1, 0) / float(faces)
+        return int(ceil(self.count / (1 - chance)))
+    def compile(self):
+        count, low, high = self.count, self.low, self.high
+        explode = self.explode
+        reroll = target = None
+        if self.reroll:
+            compare, n = self.reroll
+            reroll = lambda roll: COMPARISONS[compare](roll, n)
+        keeps = [_keeper(kind, n) for kind, n in self.keeps]
+        suffix = ''
+        if self.target:
+            compare, n = self.target
+            target = lambda roll: COMPARISONS[compare](roll, n)
+            suffix = "%s%d" % (compare, n)
+        def run():
+            rolls = [rand(low, high) for i in xrange(count)]
+            if reroll:
+                rolls = [rand(low, high) if reroll(roll) else roll
+                         for roll in rolls]
+            if explode is not None:
+                more = sum(roll >= explode for roll in rolls)
+                while more:
+                    if len(rolls) + more > MAX_DICE:
+                        raise TooManyDice
+                    wave = [rand(low, high) for i in xrange(more)]
+                    rolls.extend(wave)
+                    more = sum(roll >= explode for roll in wave)
+            kept = [True] * len(rolls)
+            for keep in keeps:
+                keep(rolls, kept)
+            if target:
+                value = sum(1 for roll, k in zip(rolls, kept)
+                            if k and target(roll))
+            else:
+                value = sum(roll for roll, k in zip(rolls, kept) if k)
+            shown = ', '.join(str(roll) if k else "~%s" % roll
+                              for roll, k in zip(rolls, kept))
+            return value, "[%s]%s" % (shown, suffix)
+        return run
+
+# ~~~~~~~ The parser
+
+class _Parser(object):
+    def __init__(self, tokens):
+        if len(tokens) > MAX_TOKENS:
+            raise TooComplex("That roll is too long.")
+        self.tokens = tokens
+        self.pos = 0
+        self.depth = 0
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise ParseError("That roll ends too soon.")
+        self.pos += 1
+        return token
+    def number(self, default=None):
+        if isinstance(self.peek(), (int, long)):
+            return self.next()
+        if default is None:
+            raise ParseError("Expected a number, not %s" % self.peek())
+        return default
+    def parse(self):
+        tree = self.expression()
+        if self.peek() is not None:
+            raise ParseError("I don't understand %s" % self.peek())
+        if not tree.dice:
+            raise ParseError("There are no dice in that.")
+        return tree
+    def expression(self):
+        tree = self.term()
+        while self.peek() in ('+', '-'):
+            op = self.next()
+            tree = BinaryOp(op, tree, self.term())
+        return tree
+    def term(self):
+        tree = self.factor()
+        while self.peek() in ('*', '/'):
+            op = self.next()
+            tree = BinaryOp(op, tree, self.factor())
+        return tree
+    def nest(self, parse):
+        """parse(), one level deeper."""
+        if self.depth >= MAX_DEPTH:
+            raise TooComplex("That roll is nested too deep.")
+        self.depth += 1
+        try:
+            return parse()
+        finally:
+            self.depth -= 1
+    def factor(self):
+        token = self.peek()
+        if token == '-':
+            self.next()
+            return Negative(self.nest(self.factor))
+        if token == '(':
+            self.next()
+            tree = self.nest(self.expression)
+            if self.next() != ')':
+                raise ParseError("Unbalanced parentheses.")
+            return Group(tree)
+        if token == 'd':
+            return self.dice(1)
+        count = self.number()
+        if self.peek() == 'd':
+            return self.dice(count)
+        return Number(count)
+    def dice(self, count):
+        self.next()
+        sides = self.next()
+        if sides == 'f':
+            dice = Dice(count, -1, 1)
+        elif sides == '%':
+            dice = Dice(count, 1, 100)
+        elif isinstance(sides, (int, long)) and sides > 0:
+            dice = Dice(count, 1, sides)
+        else:
+            raise ParseError("Dice need a number of sides, not %s" % sides)
+        while True:
+            token = self.peek()
+            if token in ('k', 'kh', 'kl', 'dh', 'dl'):
+                self.next()
+                if token == 'k':
+                    token = 'kh'
+                dice.keeps.append((token, self.number(1)))
+            elif token == '!':
+                self.next()
+                dice.explode = self.number(dice.high)
+                if dice.explode <= dice.low:
+                    raise ParseError("Every die would explode forever.")
+            elif token == 'r':
+                self.next()
+                compare = '='
+                if self.peek() in COMPARISONS:
+                    compare = self.next()
+                dice.reroll = (compare, self.number())
+            else:
+                break
+        if self.peek() in COMPARISONS:
+            dice.target = (self.next(), self.number())
+        return dice
+
+def parse(text):
+    """The tree for the expression text; raises ParseError if it isn't one."""
+    return _Parser(tokenize(text)).parse()
+
+class Expression(object):
+    """
+    A compiled expression.  Calling it rolls it, and returns the total and
+    the dice that made it.
+    """
+    def __init__(self, text):
+        self.text = text
+        tree = parse(text)
+        self.dice = tree.dice
+        self._run = tree.compile()
+    def __call__(self):
+        try:
+            value, shown = self._run()
+        except ZeroDivisionError:
+            return "Can't divide by zero."
+        except TooManyDice:
+            return "That exploded into more than %d dice." % MAX_DICE
+        return "%s (%s)" % (value, shown)
+    def __repr__(self):
+        return "<Expression %s>" % self.text
+
+def compile(text):
+    """The Expression for text, from the cache if it's been seen before."""
+    text = text.strip()
+    expression = cache.get(text)
+    if expression is None:
+        expression = cache[text] = Expression(text)
+    return expression
+
+def roll(text):
+    return compile(text)()
@@ -0,0 +1,142 @@
+"""
+A pool of worker threads for running bot commands off the serve loop.
+"""
+
+import threading
+import time
+import Queue
+from collections import deque
+from scheduler import clock
+
+class _Task(object):
+    __slots__ = ('key', 'fn', 'args', 'done', 'expired', 'started',
+                 'abandoned')
+    def __init__(self, key, fn, args, done, expired):
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.done = done
+        self.expired = expired
+        self.started = None
+        self.abandoned = False
+
+class Executor(object):
+    """
+    Runs calls on a pool of worker threads, one at a time per key, in the
+    order they were submitted.  Bot keys calls by conversation, so replies to
+    one room or person keep their order while other rooms carry on.
+
+    A call still running after timeout seconds is abandoned: its expired
+    callback runs, the next call for its key starts, and a fresh worker takes
+    the stuck one's place.  Python can't kill a thread, so the stuck call
+    runs on, but its result is thrown away.
+
+    If a call or callback raises, on_error is called with the exception.
+    """
+    def __init__(self, workers=4, timeout=30, on_error=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.on_error = on_error
+        self._lock = threading.Lock()
+        self._ready = Queue.Queue() # keys with a call ready to run
+        self._pending = {} # key -> deque of calls, while the key is active
+        self._running = set()
+        self._threads = 0
+        self._stopped = False
+    def start(self):
+        for i in range(self.workers):
+            self.__add_worker()
+        self.__spawn(self.__watch)
+    def stop(self):
+        """Let the workers finish what they're running, and then exit."""
+        self._stopped = True
+        with self._lock:
+            threads = self._threads
+        for i in range(threads):
+            self._ready.put(None)
+    def submit(self, key, fn, args=(), done=None, expired=None):
+        """
+        Queue fn(*args) to run after every earlier call with the same key.
+        Then done is called with its result, or expired is called with no
+        arguments if it runs out of time.
+        """
+        task = _Task(key, fn, args, done, expired)
+        with self._lock:
+            queue = self._pending.get(key)
+            if queue is not None:
+                queue.append(task)
+                return
+            self._pending[key] = deque([task])
+        self._ready.put(key)
+    def busy(self):
+        """Is anything running or waiting to run?"""
+        return bool(self._pending)
+    def __add_worker(self):
+        with self._lock:
+            self._threads += 1
+        self.__spawn(self.__work)
+    def __spawn(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+    def __release(self, key):
+        with self._lock:
+            if self._pending[key]:
+                self._ready.put(key)
+            else:
+                del self._pending[key]
+    def __failed(self, e):
+        if self.on_error is not None:
+            self.on_error(e)
+    def __work(self):
+        while True:
+            key = self._ready.get()
+            if key is None:
+                return
+            with self._lock:
+                task = self._pending[key].popleft()
+                task.started = clock()
+                self._running.add(task)
+            try:
+                result = task.fn(*task.args)
+            except Exception, e:
+                result = None
+                self.__failed(e)
+            retire = False
+            with self._lock:
+                abandoned = task.abandoned
+                if not abandoned:
+                    self._running.discard(task)
+                elif self._threads > self.workers:
+                    self._threads -= 1
+                    retire = True
+            if retire:
+                return
+            if abandoned:
+                continue
+            if task.done is not None:
+                try:
+                    task.done(result)
+                except Exception, e:
+                    self.__failed(e)
+            self.__release(key)
+    def __watch(self):
+        tick = min(1.0, self.timeout / 4.0)
+        while not self._stopped:
+            time.sleep(tick)
+            now = clock()
+            expired = []
+            with self._lock:
+                for task in list(self._running):
+                    if now - task.started > self.timeout:
+                        task.abandoned = True
+                        self._running.discard(task)
+                        expired.append(task)
+            for task in expired:
+                self.__add_worker()
+                if task.expired is not None:
+                    try:
+                        task.expired()
+                    except Exception, e:
+                        self.__failed(e)
+                self.__release(task.key)
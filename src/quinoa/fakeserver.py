@@ -0,0 +1,502 @@
+"""
+A small local XMPP server, for soak tests.
+
+It does just enough for a bot to connect and work: SASL PLAIN, resource
+binding, sessions, roster requests, pings, presence, chat messages and
+multi-user chat rooms with invites.  There is no TLS, no storage and no
+federation; stanzas for any other server bounce.
+
+Simulated people can be added with add_user(), without sockets of their
+own, so hundreds of them cost little.
+"""
+
+import base64
+import socket
+import asyncore
+import itertools
+from collections import OrderedDict, deque
+from xml.parsers import expat
+from xml.sax.saxutils import escape, quoteattr
+
+NS_CLIENT = 'jabber:client'
+NS_STREAMS = 'http://etherx.jabber.org/streams'
+NS_SASL = 'urn:ietf:params:xml:ns:xmpp-sasl'
+NS_BIND = 'urn:ietf:params:xml:ns:xmpp-bind'
+NS_SESSION = 'urn:ietf:params:xml:ns:xmpp-session'
+NS_STANZAS = 'urn:ietf:params:xml:ns:xmpp-stanzas'
+NS_ROSTER = 'jabber:iq:roster'
+NS_PING = 'urn:xmpp:ping'
+NS_MUC = 'http://jabber.org/protocol/muc'
+NS_MUC_USER = 'http://jabber.org/protocol/muc#user'
+NS_DELAY = 'urn:xmpp:delay'
+
+class Element(object):
+    """Just enough of an XML element to read stanzas and write them back."""
+    __slots__ = ('name', 'attrs', 'ns', 'children', 'text')
+    def __init__(self, name, attrs=None, ns=None, children=None, text=u''):
+        self.name = name
+        self.attrs = dict(attrs or {})
+        if ns is not None and 'xmlns' not in self.attrs:
+            self.attrs['xmlns'] = ns
+        self.ns = self.attrs.get('xmlns', ns)
+        self.children = list(children or [])
+        self.text = text
+    def get(self, attr, default=None):
+        return self.attrs.get(attr, default)
+    def find(self, name, ns=None):
+        """The first child called name, in namespace ns if given."""
+        for child in self.children:
+            if child.name == name and (ns is None or child.ns == ns):
+                return child
+        return None
+    def add(self, name, attrs=None, ns=None, text=u''):
+        child = Element(name, attrs, ns, text=text)
+        self.children.append(child)
+        return child
+    def copy(self, **attrs):
+        """A shallow copy, with attrs replaced; None removes one."""
+        element = Element(self.name, self.attrs, children=self.children,
+                          text=self.text)
+        element.ns = self.ns
+        for attr, value in attrs.iteritems():
+            if value is None:
+                element.attrs.pop(attr, None)
+            else:
+                element.attrs[attr] = value
+        return element
+    def body(self):
+        body = self.find('body')
+        return body.text if body is not None else None
+    def to_xml(self):
+        out = [u'<', self.name]
+        for attr, value in self.attrs.iteritems():
+            out.append(u' %s=%s' % (attr, quoteattr(value)))
+        if not self.children and not self.text:
+            out.append(u'/>')
+            return u''.join(out)
+        out.append(u'>')
+        if self.text:
+            out.append(escape(self.text))
+        for child in self.children:
+            out.append(child.to_xml())
+        out.append(u'</%s>' % self.name)
+        return u''.join(out)
+    __unicode__ = to_xml
+
+def split_jid(jid):
+    """(node, domain, resource) of jid; missing parts are empty."""
+    node, domain, resource = u'', jid, u''
+    if '/' in domain:
+        domain, resource = domain.split('/', 1)
+    if '@' in domain:
+        node, domain = domain.split('@', 1)
+    return node, domain.lower(), resource
+
+def bare(jid):
+    return jid.split('/', 1)[0]
+
+def error(stanza, condition, code, type='cancel'):
+    """An error reply to stanza."""
+    reply = stanza.copy(type='error', to=stanza.get('from'),
+                        **{'from': stanza.get('to')})
+    err = Element('error', {'type': type, 'code': code})
+    err.add(condition, ns=NS_STANZAS)
+    reply.children = reply.children + [err]
+    return reply
+
+class _StreamParser(object):
+    """
+    Feeds bytes of an XML stream to expat, calling stanza(element) for each
+    complete top-level element, opened(attrs) for the stream header and
+    closed() at its end.
+    """
+    def __init__(self, opened, stanza, closed):
+        self.opened = opened
+        self.stanza = stanza
+        self.closed = closed
+        self.reset()
+    def reset(self):
+        """Start over, for a stream restarted after authentication."""
+        parser = expat.ParserCreate('UTF-8')
+        parser.buffer_text = True
+        parser.StartElementHandler = self.__start
+        parser.EndElementHandler = self.__end
+        parser.CharacterDataHandler = self.__text
+        self._parser = parser
+        self._stack = []
+    def feed(self, data):
+        self._parser.Parse(data, False)
+    def __start(self, name, attrs):
+        if not self._stack:
+            self._stack.append(None)
+            self.opened(attrs)
+            return
+        parent = self._stack[-1]
+        ns = attrs.get('xmlns') or (parent.ns if parent else NS_CLIENT)
+        element = Element(name, attrs)
+        element.ns = ns
+        if parent is not None:
+            parent.children.append(element)
+        self._stack.append(element)
+    def __end(self, name):
+        element = self._stack.pop()
+        if len(self._stack) == 1:
+            self.stanza(element)
+        elif not self._stack:
+            self.closed()
+    def __text(self, data):
+        element = self._stack[-1] if self._stack else None
+        if element is not None:
+            element.text += data
+
+class VirtualUser(object):
+    """
+    Someone connected to the server without a socket.  Call the methods
+    below to act; everything sent to them is passed to on_stanza, if set.
+    """
+    priority = 0
+    def __init__(self, server, jid, on_stanza=None):
+        self.server = server
+        self.jid = jid
+        self.on_stanza = on_stanza
+        self.available = True
+    def deliver(self, stanza):
+        if self.on_stanza is not None:
+            self.on_stanza(self, stanza)
+    def send(self, stanza):
+        self.server.route(self, stanza)
+    def join(self, room, nick):
+        presence = Element('presence', {'to': '%s/%s' % (room, nick)})
+        x = presence.add('x', ns=NS_MUC)
+        x.add('history', {'maxchars': '0'})
+        self.send(presence)
+    def leave(self, room, nick):
+        self.send(Element('presence', {'to': '%s/%s' % (room, nick),
+                                       'type': 'unavailable'}))
+    def say(self, to, text, type='groupchat'):
+        message = Element('message', {'to': to, 'type': type})
+        message.add('body', text=text)
+        self.send(message)
+    def invite(self, room, jid):
+        message = Element('message', {'to': room})
+        x = message.add('x', ns=NS_MUC_USER)
+        x.add('invite', {'to': jid})
+        self.send(message)
+
+class _Connection(asyncore.dispatcher):
+    """One client's socket, from stream header to stream end."""
+    def __init__(self, server, sock):
+        asyncore.dispatcher.__init__(self, sock, map=server.map)
+        self.server = server
+        self.jid = None
+        self.user = None
+        self.priority = 0
+        self.available = False
+        self._out = []
+        self._restart = False
+        self._parser = _StreamParser(self.__opened, self.__stanza,
+                                     self.__closed)
+    def write(self, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        self._out.append(text)
+    def deliver(self, stanza):
+        self.write(stanza.to_xml())
+    def writable(self):
+        return bool(self._out)
+    def handle_write(self):
+        data = ''.join(self._out)
+        sent = self.send(data[:65536])
+        self._out = [data[sent:]] if sent < len(data) else []
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return
+        try:
+            self._parser.feed(data)
+        except expat.ExpatError:
+            self.handle_close()
+            return
+        if self._restart:
+            self._restart = False
+            self._parser.reset()
+    def handle_close(self):
+        self.server.disconnected(self)
+        self.close()
+    def __opened(self, attrs):
+        self.write(u"<?xml version='1.0'?><stream:stream xmlns='%s' "
+                   u"xmlns:stream='%s' id='%d' from='%s' version='1.0'>" %
+                   (NS_CLIENT, NS_STREAMS, next(self.server.ids),
+                    self.server.domain))
+        features = Element('stream:features')
+        if self.user is None:
+            mechanisms = features.add('mechanisms', ns=NS_SASL)
+            mechanisms.add('mechanism', text=u'PLAIN')
+        else:
+            features.add('bind', ns=NS_BIND)
+            features.add('session', ns=NS_SESSION)
+        self.write(features.to_xml())
+    def __closed(self):
+        self.write(u'</stream:stream>')
+        self.handle_close()
+    def __stanza(self, stanza):
+        if self.user is None:
+            return self.__authenticate(stanza)
+        if self.jid is None:
+            if stanza.name == 'iq' and stanza.find('bind', NS_BIND):
+                return self.__bind(stanza)
+            return self.deliver(error(stanza, 'not-authorized', '401'))
+        self.server.route(self, stanza)
+    def __authenticate(self, stanza):
+        if stanza.name != 'auth' or stanza.get('mechanism') != 'PLAIN':
+            self.write(u"<failure xmlns='%s'><invalid-mechanism/></failure>"
+                       % NS_SASL)
+            return
+        try:
+            authzid, user, password = \
+                    base64.b64decode(stanza.text).decode('utf-8').split(u'\0')
+        except (TypeError, ValueError):
+            user = password = None
+        if not user or not self.server.check_password(user, password):
+            self.write(u"<failure xmlns='%s'><not-authorized/></failure>"
+                       % NS_SASL)
+            return
+        self.user = user
+        self.write(u"<success xmlns='%s'/>" % NS_SASL)
+        self._restart = True
+    def __bind(self, stanza):
+        resource = stanza.find('bind', NS_BIND).find('resource')
+        resource = resource.text if resource is not None and resource.text \
+                else u'quinoa%d' % next(self.server.ids)
+        jid = u'%s@%s/%s' % (self.user, self.server.domain, resource)
+        old = self.server.sessions.get(jid)
+        if old is not None and old is not self:
+            old.handle_close()
+        self.jid = jid
+        self.server.sessions[jid] = self
+        reply = Element('iq', {'type': 'result', 'id': stanza.get('id', '')})
+        reply.add('bind', ns=NS_BIND).add('jid', text=jid)
+        self.deliver(reply)
+
+class Server(asyncore.dispatcher):
+    """
+    Listens on (host, port), serving domain and its rooms at muc_domain.
+    Port 0 picks a free port, which is then in self.port.  With accounts,
+    a dict of username -> password, only those may log in; without, anyone
+    may, with any password.
+
+    Call loop() to serve; on_groupchat(room, nick, text), if set, is called
+    for every message said in a room.
+    """
+    history_size = 20
+    def __init__(self, host='127.0.0.1', port=0, domain='localhost',
+                 muc_domain=None, accounts=None):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(128)
+        self.host = host
+        self.port = self.socket.getsockname()[1]
+        self.domain = domain
+        self.muc_domain = muc_domain or 'conference.' + domain
+        self.accounts = accounts
+        self.ids = itertools.count(1)
+        self.sessions = {} # full JID -> connection or VirtualUser
+        self.rooms = {} # room JID -> OrderedDict of nick -> full JID
+        self.history = {} # room JID -> deque of messages
+        self.on_groupchat = None
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            _Connection(self, pair[0])
+    def loop(self, timeout=0.1, count=None):
+        asyncore.loop(timeout, map=self.map, count=count)
+    def check_password(self, user, password):
+        return self.accounts is None or self.accounts.get(user) == password
+    def add_user(self, jid, on_stanza=None):
+        """A VirtualUser with the full JID jid, already online."""
+        user = VirtualUser(self, jid, on_stanza)
+        self.sessions[jid] = user
+        return user
+    def disconnected(self, session):
+        if session.jid is None or \
+                self.sessions.get(session.jid) is not session:
+            return
+        del self.sessions[session.jid]
+        for room, occupants in self.rooms.items():
+            for nick, jid in occupants.items():
+                if jid == session.jid:
+                    self.__leave(room, nick)
+    def occupants(self, room):
+        return self.rooms.get(room, {})
+    def route(self, session, stanza):
+        """Deliver a stanza sent by session to wherever it's going."""
+        stanza.attrs['from'] = session.jid
+        to = stanza.get('to')
+        node, domain, resource = split_jid(to or self.domain)
+        if domain == self.muc_domain and node:
+            return self.__muc(session, stanza, node + '@' + domain, resource)
+        if domain != self.domain:
+            if stanza.get('type') not in ('error', 'result'):
+                session.deliver(error(stanza, 'remote-server-not-found',
+                                      '404'))
+            return
+        if not node:
+            return self.__server(session, stanza)
+        if stanza.name == 'presence' and not resource:
+            return # Subscriptions and the like; there are no rosters.
+        for target in self.__targets(to):
+            target.deliver(stanza)
+    def __targets(self, to):
+        if '/' in to:
+            target = self.sessions.get(to)
+            return [target] if target is not None else []
+        sessions = [s for jid, s in self.sessions.iteritems()
+                    if bare(jid) == to and s.available and s.priority >= 0]
+        if not sessions:
+            return []
+        top = max(s.priority for s in sessions)
+        return [s for s in sessions if s.priority == top]
+    def __server(self, session, stanza):
+        kind = stanza.get('type')
+        if stanza.name == 'presence':
+            session.available = kind != 'unavailable'
+            priority = stanza.find('priority')
+            try:
+                session.priority = int(priority.text)
+            except (AttributeError, ValueError):
+                session.priority = 0
+            return
+        if stanza.name != 'iq' or kind not in ('get', 'set'):
+            return
+        reply = Element('iq', {'type': 'result', 'id': stanza.get('id', ''),
+                               'to': session.jid, 'from': self.domain})
+        if stanza.find('session', NS_SESSION) or stanza.find('ping', NS_PING):
+            pass
+        elif stanza.find('query', NS_ROSTER):
+            reply.add('query', ns=NS_ROSTER)
+        else:
+            reply = error(stanza, 'service-unavailable', '503')
+        session.deliver(reply)
+    # ~~~~~~~ Rooms
+    def __presence(self, room, nick, jid, kind=None):
+        presence = Element('presence', {'from': '%s/%s' % (room, nick)})
+        if kind:
+            presence.attrs['type'] = kind
+        x = presence.add('x', ns=NS_MUC_USER)
+        x.add('item', {'affiliation': 'none',
+                       'role': 'none' if kind else 'participant'})
+        return presence
+    def __broadcast(self, room, stanza, about=None):
+        for nick, jid in self.rooms.get(room, {}).items():
+            target = self.sessions.get(jid)
+            if target is None:
+                continue
+            if about is not None and jid == about:
+                out = stanza.copy(to=jid)
+                x = out.find('x', NS_MUC_USER)
+                if x is not None:
+                    out.children = [c for c in out.children if c is not x]
+                    x = Element('x', ns=NS_MUC_USER,
+                                children=x.children + [Element('status',
+                                        {'code': '110'})])
+                    out.children.append(x)
+                target.deliver(out)
+            else:
+                target.deliver(stanza.copy(to=jid))
+    def __join(self, session, stanza, room, nick):
+        occupants = self.rooms.setdefault(room, OrderedDict())
+        if occupants.get(nick, session.jid) != session.jid:
+            return session.deliver(error(stanza, 'conflict', '409'))
+        for old, jid in occupants.items():
+            if jid == session.jid and old != nick:
+                self.__leave(room, old)
+        joining = nick not in occupants
+        occupants[nick] = session.jid
+        if joining:
+            for other, jid in occupants.items():
+                if other != nick:
+                    presence = self.__presence(room, other, jid)
+                    presence.attrs['to'] = session.jid
+                    session.deliver(presence)
+        self.__broadcast(room, self.__presence(room, nick, session.jid),
+                         about=session.jid)
+        if joining:
+            self.__send_history(session, stanza, room)
+    def __send_history(self, session, stanza, room):
+        limit = self.history_size
+        x = stanza.find('x', NS_MUC)
+        history = x.find('history') if x is not None else None
+        if history is not None and (history.get('maxchars') == '0' or
+                                    history.get('maxstanzas') == '0'):
+            return
+        if history is not None and history.get('maxstanzas'):
+            limit = int(history.get('maxstanzas'))
+        for message in list(self.history.get(room, ()))[-limit:]:
+            session.deliver(message.copy(to=session.jid))
+    def __leave(self, room, nick):
+        occupants = self.rooms.get(room)
+        if not occupants or nick not in occupants:
+            return
+        jid = occupants[nick]
+        self.__broadcast(room, self.__presence(room, nick, jid,
+                                               'unavailable'), about=jid)
+        del occupants[nick]
+        if not occupants:
+            del self.rooms[room]
+            self.history.pop(room, None)
+    def __nick(self, room, jid):
+        for nick, occupant in self.rooms.get(room, {}).iteritems():
+            if occupant == jid:
+                return nick
+        return None
+    def __muc(self, session, stanza, room, nick):
+        kind = stanza.get('type')
+        if stanza.name == 'presence':
+            if kind == 'unavailable':
+                return self.__leave(room, nick)
+            if kind in (None, 'available') and nick:
+                return self.__join(session, stanza, room, nick)
+            return
+        if stanza.name == 'iq':
+            if kind in ('get', 'set'):
+                session.deliver(error(stanza, 'service-unavailable', '503'))
+            return
+        x = stanza.find('x', NS_MUC_USER)
+        if x is not None and x.find('invite') is not None:
+            return self.__invite(session, room, x.find('invite'))
+        sender = self.__nick(room, session.jid)
+        if sender is None:
+            if kind != 'error':
+                session.deliver(error(stanza, 'not-acceptable', '406'))
+            return
+        if kind == 'groupchat' and not nick:
+            message = stanza.copy(**{'from': '%s/%s' % (room, sender)})
+            self.__broadcast(room, message)
+            history = self.history.setdefault(room,
+                    deque(maxlen=self.history_size))
+            stamped = message.copy()
+            stamped.children = stamped.children + [Element('delay',
+                    {'from': room, 'stamp': '2000-01-01T00:00:00Z'},
+                    ns=NS_DELAY)]
+            history.append(stamped)
+            if self.on_groupchat is not None:
+                self.on_groupchat(room, sender, stanza.body())
+        elif nick:
+            jid = self.rooms.get(room, {}).get(nick)
+            target = self.sessions.get(jid) if jid else None
+            if target is None:
+                return session.deliver(error(stanza, 'item-not-found', '404'))
+            target.deliver(stanza.copy(**{'from': '%s/%s' % (room, sender),
+                                          'to': jid}))
+    def __invite(self, session, room, invite):
+        to = invite.get('to')
+        if not to:
+            return
+        message = Element('message', {'from': room, 'to': to})
+        x = message.add('x', ns=NS_MUC_USER)
+        x.add('invite', {'from': session.jid})
+        for target in self.__targets(to):
+            target.deliver(message.copy(to=target.jid))
@@ -0,0 +1,220 @@
+"""
+Soak testing a bot class against the local stand-in server.
+
+    quinoa-loadtest mybots:MyBot --rooms 20 --users 10 --rate 0.1 \\
+        --duration 60 --body "roll 5"
+
+The bot runs in its own process and connects over a real socket; the
+simulated people live in the server's process.  Each of them says body in
+their room at random, rate times a second on average, and the time until
+the bot answers is measured.  The bot should answer body with one line.
+"""
+
+import sys
+import random
+import multiprocessing
+from ast import literal_eval
+from collections import deque
+from optparse import OptionParser
+from fakeserver import Server
+from scheduler import Scheduler, clock
+from supervisor import load_class
+
+def _serve_bot(path, overrides, jid, resource, address, rooms):
+    cls = load_class(path)
+    if overrides:
+        cls = type(cls.__name__, (cls,), overrides)
+    bot = cls(jid, resource, 'soak')
+    bot.server = address
+    bot.autojoin = list(rooms)
+    bot.serve()
+
+def percentile(values, q):
+    """The q-th percentile (0-100) of sorted values, by nearest rank."""
+    if not values:
+        return None
+    rank = int(round(q / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+class LoadTest(object):
+    """
+    Serves rooms rooms, each with users simulated people, and a bot of the
+    class at path ("package.module:Class"), with any class attributes in
+    overrides replaced.  With invite, the people invite the bot into their
+    rooms, rather than it joining them by itself.
+    """
+    jid = 'soakbot@localhost'
+    nick = 'Soak'
+    def __init__(self, path, rooms=10, users=10, rate=0.1, body='roll 5',
+                 invite=False, overrides=None, log=None):
+        if getattr(log, 'write', False):
+            self.__log = log
+        else:
+            self.__log = sys.stdout
+        self.path = path
+        self.rate = rate
+        self.body = body
+        self.invite = invite
+        self.overrides = overrides or {}
+        self.server = Server()
+        self.server.on_groupchat = self.__heard
+        self.scheduler = Scheduler()
+        self.rooms = ['soak%d@%s' % (i, self.server.muc_domain)
+                      for i in range(rooms)]
+        self.users = []
+        for r, room in enumerate(self.rooms):
+            for u in range(users):
+                user = self.server.add_user(u'user%d-%d@%s/sim' %
+                                            (r, u, self.server.domain))
+                user.join(room, u'user%d' % u)
+                self.users.append((user, room))
+        self._pending = dict((room, deque()) for room in self.rooms)
+        self._speaking = False
+        self._measuring = False
+        self.sent = 0
+        self.latencies = []
+    def log(self, text):
+        self.__log.write("%s: %s\n" % (self.__class__.__name__, text))
+    def __heard(self, room, nick, text):
+        if nick != self.nick or room not in self._pending:
+            return
+        now = clock()
+        pending = self._pending[room]
+        for line in (text or '').splitlines():
+            if not pending:
+                break
+            sent, measured = pending.popleft()
+            if measured:
+                self.latencies.append(now - sent)
+    def __speak(self, user, room):
+        if not self._speaking:
+            return
+        user.say(room, self.body)
+        self._pending[room].append((clock(), self._measuring))
+        if self._measuring:
+            self.sent += 1
+        self.scheduler.schedule_in(random.expovariate(self.rate),
+                                   self.__speak, user, room)
+    def __run_until(self, deadline, done=None):
+        while clock() < deadline and not (done and done()):
+            timeout = self.scheduler.timeout()
+            self.server.loop(0.05 if timeout is None else min(timeout, 0.05),
+                             count=1)
+            self.scheduler.run_pending()
+    def __joined(self):
+        return sum(self.nick in self.server.occupants(room)
+                   for room in self.rooms)
+    def __online(self):
+        return any(jid.startswith(self.jid + '/') and session.available
+                   for jid, session in self.server.sessions.items())
+    def run(self, duration=60, warmup=10, drain=5):
+        """
+        Start the bot, give it warmup seconds to join every room, measure
+        for duration seconds, and wait up to drain seconds for the last
+        answers.  Returns a report as a dict.
+        """
+        address = (self.server.host, self.server.port)
+        process = multiprocessing.Process(target=_serve_bot,
+                args=(self.path, self.overrides, self.jid, self.nick,
+                      address, [] if self.invite else self.rooms),
+                name="quinoa-soak-bot")
+        process.daemon = True
+        process.start()
+        try:
+            start = clock()
+            if self.invite:
+                self.__run_until(start + warmup, self.__online)
+                invited = set()
+                for user, room in self.users:
+                    if room not in invited:
+                        user.invite(room, self.jid)
+                        invited.add(room)
+            self.__run_until(start + warmup,
+                             lambda: self.__joined() == len(self.rooms))
+            joined = self.__joined()
+            if joined < len(self.rooms):
+                raise RuntimeError("The bot joined only %d of %d rooms." %
+                                   (joined, len(self.rooms)))
+            self.log("Bot joined %d rooms in %.2fs." %
+                     (joined, clock() - start))
+            self._speaking = True
+            for user, room in self.users:
+                self.scheduler.schedule_in(random.expovariate(self.rate),
+                                           self.__speak, user, room)
+            # Let the first wave go by before measuring.
+            self.__run_until(clock() + min(warmup, 1.0 / self.rate))
+            self._measuring = True
+            began = clock()
+            self.__run_until(began + duration)
+            self._speaking = False
+            ended = clock()
+            self.__run_until(ended + drain, lambda: not any(
+                    measured for pending in self._pending.values()
+                    for sent, measured in pending))
+        finally:
+            process.terminate()
+            process.join()
+        return self.report(ended - began)
+    def report(self, elapsed):
+        latencies = sorted(self.latencies)
+        return {
+            'rooms': len(self.rooms),
+            'users': len(self.users),
+            'seconds': elapsed,
+            'sent': self.sent,
+            'answered': len(latencies),
+            'unanswered': self.sent - len(latencies),
+            'sent_per_second': self.sent / elapsed,
+            'answered_per_second': len(latencies) / elapsed,
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1] if latencies else None,
+        }
+
+def format_report(report):
+    def ms(seconds):
+        return "-" if seconds is None else "%.1fms" % (seconds * 1000)
+    return "\n".join([
+        "%(users)d people in %(rooms)d rooms for %(seconds).1fs" % report,
+        "sent %(sent)d (%(sent_per_second).1f/s), answered %(answered)d "
+        "(%(answered_per_second).1f/s), unanswered %(unanswered)d" % report,
+        "latency p50 %s, p90 %s, p99 %s, max %s" % (
+                ms(report['p50']), ms(report['p90']), ms(report['p99']),
+                ms(report['max'])),
+    ])
+
+def _override(option, opt, value, parser):
+    name, value = value.split('=', 1)
+    try:
+        value = literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    parser.values.overrides[name] = value
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options] package.module:BotClass")
+    parser.add_option("--rooms", type="int", default=10,
+            help="number of rooms (default: 10)")
+    parser.add_option("--users", type="int", default=10,
+            help="simulated people per room (default: 10)")
+    parser.add_option("--rate", type="float", default=0.1,
+            help="messages a second from each person (default: 0.1)")
+    parser.add_option("--body", default="roll 5",
+            help="what people say to the bot (default: 'roll 5')")
+    parser.add_option("--duration", type="float", default=60,
+            help="seconds to measure for (default: 60)")
+    parser.add_option("--warmup", type="float", default=10,
+            help="seconds to allow for joining rooms (default: 10)")
+    parser.add_option("--invite", action="store_true", default=False,
+            help="invite the bot to rooms instead of having it join them")
+    parser.add_option("--set", action="callback", callback=_override,
+            type="string", metavar="NAME=VALUE",
+            help="override a bot class attribute; may be repeated")
+    parser.set_defaults(overrides={})
+    opts, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("a bot class is required")
+    test = LoadTest(args[0], opts.rooms, opts.users, opts.rate, opts.body,
+                    opts.invite, opts.overrides)
+    print format_report(test.run(opts.duration, opts.warmup))
@@ -0,0 +1,50 @@
+"""
+A small bounded least-recently-used cache.
+"""
+
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    """
+    A mapping that holds at most maxsize entries, dropping the least recently
+    used one to make room for a new one.  Lookups through get are counted in
+    self.hits and self.misses.  It is safe to share between threads.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+    def __contains__(self, key):
+        return key in self._data
+    def __len__(self):
+        return len(self._data)
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    def __unicode__(self):
+        return "LRUCache(%d/%d, %d hits, %d misses)" % \
+                (len(self._data), self.maxsize, self.hits, self.misses)
+    __str__ = __unicode__
+    __repr__ = __unicode__
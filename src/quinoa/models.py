@@ -0,0 +1,96 @@
+"""
+The dice bot's database of users and their aliases.
+
+Importing this loads SQLAlchemy, so the dice bot only does it the first
+time a command needs the database.
+"""
+
+import threading
+import sqlalchemy.ext.declarative
+import sqlalchemy.orm.exc
+import sqlalchemy.orm
+import sqlalchemy
+from sqlalchemy.orm.exc import NoResultFound
+
+Base = sqlalchemy.ext.declarative.declarative_base()
+class User(Base):
+    __tablename__ = 'users'
+    jid = sqlalchemy.Column(sqlalchemy.Unicode, primary_key=True)
+    batsignal = sqlalchemy.Column(sqlalchemy.Boolean)
+    points = sqlalchemy.Column(sqlalchemy.Integer, default=0)
+    def __init__(self, jid):
+        self.jid = jid
+        self.batsignal = True
+        self.points = 0
+    def __unicode__(self):
+        aliases = ' a.k.a. '.join(unicode(a) for a in self.aliases)
+        if not aliases:
+            aliases = 'No-name'
+        s = 's'
+        if self.points == 1 or self.points == -1:
+            s = ''
+        return "%s (%s), %d point%s" % (aliases, self.jid, self.points, s)
+    __str__ = __unicode__
+
+class JidAlias(Base):
+    __tablename__ = 'jid_aliases'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    additional_jid = sqlalchemy.Column(sqlalchemy.Unicode)
+    primary_jid = sqlalchemy.Column(sqlalchemy.Unicode, \
+                             sqlalchemy.ForeignKey('users.jid'))
+    user = sqlalchemy.orm.relation(User, \
+            backref=sqlalchemy.orm.backref('jid_aliases', order_by=id))
+    def __init__(self, additional_jid):
+        self.additional_jid = additional_jid
+
+class Alias(Base):
+    __tablename__ = 'aliases'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    user_jid = sqlalchemy.Column(sqlalchemy.Unicode, \
+                             sqlalchemy.ForeignKey('users.jid'))
+    name = sqlalchemy.Column(sqlalchemy.Unicode)
+    user = sqlalchemy.orm.relation(User, \
+            backref=sqlalchemy.orm.backref('aliases', order_by=id))
+    def __init__(self, name):
+        self.name = name
+    def __unicode__(self):
+        return self.name
+    __str__ = __unicode__
+
+class PendingConnection(Base):
+    __tablename__ = 'pending_connections'
+    primary_jid = sqlalchemy.Column(sqlalchemy.Unicode)
+    additional_jid = sqlalchemy.Column(sqlalchemy.Unicode, primary_key=True)
+    def __init__(self, primary_jid, additional_jid):
+        self.primary_jid = primary_jid
+        self.additional_jid = additional_jid
+    def process(self, msg, session):
+        if msg.getBody().strip('!').lower() == 'y':
+            ret = True
+            try:
+                user = session.query(User).filter_by(jid=self.primary_jid).one()
+            except NoResultFound:
+                return False
+            session.add(user)
+            user.jid_aliases.append(JidAlias(self.additional_jid))
+            session.commit()
+        else:
+            ret = False
+        return ret
+
+_sessions = {} # database URL -> session factory
+_lock = threading.Lock()
+
+def connect(url):
+    """
+    A session factory for the database at url, creating the engine and any
+    missing tables the first time it's asked for.
+    """
+    with _lock:
+        Session = _sessions.get(url)
+        if Session is None:
+            engine = sqlalchemy.create_engine(url)
+            Base.metadata.create_all(engine)
+            Session = _sessions[url] = \
+                    sqlalchemy.orm.sessionmaker(bind=engine)
+        return Session
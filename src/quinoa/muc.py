@@ -0,0 +1,94 @@
+"""
+Joining multi-user chat rooms.
+"""
+
+import threading
+import xmppony as xmpp
+
+class JoinManager(object):
+    """
+    Tracks every room join in flight, by room JID, so any number of them can
+    be sent at once.  When a room says our nick is taken, we try again there
+    with an underscore added, up to max_retries times.
+
+    Joins ask the room not to replay its history at us.
+
+    Give every presence stanza to handle(); it returns True for the ones
+    that answered a join.  joined(room, nick) is called for each room we get
+    into, and failed(room, reason) for each we don't.
+    """
+    max_retries = 5
+    def __init__(self, send, joined, failed=None):
+        self.send = send
+        self.joined = joined
+        self.failed = failed
+        self._pending = {} # room -> [nick, retries]
+        self._lock = threading.Lock()
+    def __len__(self):
+        return len(self._pending)
+    def __contains__(self, room):
+        return room in self._pending
+    def _presence(self, room, nick):
+        to = xmpp.protocol.JID(room + '/' + nick)
+        presence = xmpp.protocol.Presence(to=to)
+        x = presence.setTag('x', namespace=xmpp.protocol.NS_MUC)
+        x.setTag('history', attrs={'maxchars': '0'})
+        return presence
+    def join(self, room, nick):
+        """Send a join for room, given as room@service."""
+        with self._lock:
+            self._pending[room] = [nick, 0]
+        self.send(self._presence(room, nick))
+    def reset(self):
+        """Forget every join in flight, and return their rooms."""
+        with self._lock:
+            rooms = self._pending.keys()
+            self._pending.clear()
+        return rooms
+    def cancel(self, room):
+        """Forget about a join; any answer to it will be ignored."""
+        with self._lock:
+            return self._pending.pop(room, None) is not None
+    def handle(self, msg):
+        frm = msg.getFrom()
+        if frm is None:
+            return False
+        room = frm.getStripped()
+        with self._lock:
+            pending = self._pending.get(room)
+            if pending is None:
+                return False
+            nick = pending[0]
+            if msg.getType() == 'error':
+                if msg.getErrorCode() == '409' and \
+                        pending[1] < self.max_retries:
+                    pending[0] = nick = nick + '_'
+                    pending[1] += 1
+                    retry = True
+                else:
+                    del self._pending[room]
+                    retry = False
+            elif frm.getResource() == nick or _is_self_presence(msg):
+                del self._pending[room]
+                nick = frm.getResource()
+                retry = None
+            else:
+                # Someone already in the room; ours is still to come.
+                return True
+        if retry:
+            self.send(self._presence(room, nick))
+        elif retry is None:
+            self.joined(room, nick)
+        elif self.failed is not None:
+            self.failed(room, msg.getErrorCode())
+        return True
+
+def _is_self_presence(msg):
+    """Does this room presence carry status code 110, meaning it's ours?"""
+    x = msg.getTag('x', namespace='http://jabber.org/protocol/muc#user')
+    if x is None:
+        return False
+    for status in x.getTags('status'):
+        if status.getAttr('code') == '110':
+            return True
+    return False
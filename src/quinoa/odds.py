@@ -0,0 +1,228 @@
+"""
+The exact odds of the dice bot's rolls.
+
+Each function here takes the same arguments as the roll of the same name in
+quinoa.dicebot and returns an Odds: the chance of every number of successes,
+and of the outcomes (botches and the like) that aren't one.  Distributions
+are kept as lists of probabilities indexed by number of successes, and built
+up by convolving one die's at a time.  Dice that explode are followed until
+what's left is too small to show.  Answers are kept in an LRUCache, so asking
+again costs nothing.
+"""
+
+from lru import LRUCache
+
+# Chances smaller than this are dropped.
+EPSILON = 1e-15
+
+cache = LRUCache(256)
+
+def memoized(fn):
+    """Keep fn's answers in cache, keyed by its name and arguments."""
+    def wrapper(*args):
+        key = (fn.__name__,) + args
+        odds = cache.get(key)
+        if odds is None:
+            odds = cache[key] = fn(*args)
+        return odds
+    wrapper.__name__ = fn.__name__
+    wrapper.__doc__ = fn.__doc__
+    return wrapper
+
+def _percent(p):
+    if 0 < p < 0.0005:
+        return "<0.1%"
+    return "%.1f%%" % (p * 100)
+
+class Odds(object):
+    """
+    The chances of a roll: successes[n] of n successes, and each (name,
+    chance) in specials of an outcome that isn't counted in successes.  Each
+    (name, chance) in extras is for something that can happen along with
+    successes, like a Shadowrun glitch.  noun is what successes are called.
+    """
+    # How many "at least" chances to give.
+    at_least = 5
+    def __init__(self, successes, specials=(), extras=(), noun='successes'):
+        self.successes = _trim(successes)
+        self.specials = list(specials)
+        self.extras = list(extras)
+        self.noun = noun
+    def chance(self, n=1):
+        """The chance of at least n successes."""
+        return sum(self.successes[n:])
+    def mean(self):
+        return sum(n * p for n, p in enumerate(self.successes))
+    def __unicode__(self):
+        parts = ["Success %s" % _percent(self.chance(1)),
+                 "failure %s" % _percent(self.successes[0])]
+        parts.extend("%s %s" % (name, _percent(p))
+                     for name, p in self.specials + self.extras)
+        ret = ', '.join(parts)
+        ret += "; %.2f %s on average" % (self.mean(), self.noun)
+        at_least = []
+        for n in range(2, len(self.successes)):
+            p = self.chance(n)
+            if p < 0.0005 or len(at_least) == self.at_least:
+                break
+            at_least.append("%d: %s" % (n, _percent(p)))
+        if at_least:
+            ret += "; at least " + ', '.join(at_least)
+        return ret + "."
+    __str__ = __unicode__
+
+def _add(total, dist, weight=1.0, shift=0):
+    """Add dist, times weight and moved up by shift successes, to total."""
+    if len(total) < len(dist) + shift:
+        total.extend([0.0] * (len(dist) + shift - len(total)))
+    for n, p in enumerate(dist):
+        total[n + shift] += p * weight
+
+def _trim(dist):
+    """dist without the chances too small to matter at its end."""
+    while len(dist) > 1 and dist[-1] < EPSILON:
+        dist.pop()
+    return dist
+
+def _convolve(a, b):
+    """The distribution of the sum of two independent counts."""
+    total = [0.0] * (len(a) + len(b) - 1)
+    for i, p in enumerate(a):
+        if p:
+            for j, q in enumerate(b):
+                total[i + j] += p * q
+    return _trim(total)
+
+def _sums(die, dice):
+    """The distributions of the sum of 0, 1, ... dice independent dice."""
+    sums = [[1.0]]
+    for i in range(dice):
+        sums.append(_convolve(sums[-1], die))
+    return sums
+
+def _binomial(n, p):
+    """The chances of 0 to n of n tries coming off, each with chance p."""
+    if p <= 0:
+        return [1.0]
+    q = 1 - p
+    dist = [q ** n]
+    for k in range(n):
+        dist.append(dist[-1] * (n - k) / (k + 1) * p / q)
+    return dist
+
+def _mix(faces, then):
+    """
+    Successes from a die showing each of faces, given as (successes,
+    explodes), equally often, where one that explodes goes on to add then.
+    """
+    dist = []
+    for successes, explodes in faces:
+        _add(dist, then if explodes else [1.0], 1.0 / len(faces), successes)
+    return dist
+
+def _exploding(faces):
+    """Successes from a die of faces that's rolled again as it explodes."""
+    explode = sum(1 for successes, explodes in faces if explodes) / \
+            float(len(faces))
+    if explode >= 1:
+        raise ValueError("Every die would explode forever.")
+    dist = [1.0]
+    missing = 1.0
+    while missing > EPSILON:
+        dist = _mix(faces, dist)
+        missing *= explode
+    return _trim(dist)
+
+def _d10(succeed, explode):
+    return [(int(succeed(face)), explode(face)) for face in range(1, 11)]
+
+@memoized
+def owod(dice, diff, spec=False, will=False):
+    spec = bool(spec)
+    faces = _d10(lambda face: face >= diff, lambda face: spec and face == 10)
+    again = _exploding(faces) if spec else [1.0]
+    # Only the first roll's ones count, so work out the rest of the pool for
+    # each number of them.
+    rest = _mix(faces[1:], again)
+    one = faces[0][0]
+    sums = _sums(rest, dice)
+    successes = [0.0] * (len(sums[-1]) + dice + 2)
+    botch = 0.0
+    for n, p in enumerate(_binomial(dice, 0.1)):
+        for s, q in enumerate(sums[dice - n]):
+            s += n * one + bool(will)
+            if not s and n:
+                botch += p * q
+            else:
+                successes[max(0, s - n)] += p * q
+    return Odds(successes, [("botch", botch)])
+
+@memoized
+def nwod(dice, again=10, rote=False):
+    threshold = 8
+    chance = False
+    specials = []
+    if dice < 1:
+        dice = 1
+        threshold = 10
+        again = 10
+        chance = True
+    faces = _d10(lambda face: face >= threshold, lambda face: face >= again)
+    chain = _exploding(faces)
+    first = []
+    for face, (successes, explodes) in enumerate(faces):
+        if chance and face == 0:
+            specials.append(("critical failure", 0.1))
+        elif rote and not successes:
+            _add(first, chain, 0.1)
+        else:
+            _add(first, chain if explodes else [1.0], 0.1, successes)
+    return Odds(_sums(first, dice)[-1], specials)
+
+@memoized
+def exalted(dice):
+    # Sevens to nines are one success and tens two, if it didn't roll a one.
+    rest = [5 / 9., 3 / 9., 1 / 9.]
+    sums = _sums(rest, dice)
+    successes = [0.0]
+    botch = 0.0
+    for n, p in enumerate(_binomial(dice, 0.1)):
+        dist = sums[dice - n]
+        if n:
+            botch += p * dist[0]
+            _add(successes, [0.0] + dist[1:], p)
+        else:
+            _add(successes, dist, p)
+    return Odds(successes, [("botch", botch)])
+
+@memoized
+def shadowrun(pool, leftover, ro6):
+    # With the rule of six, every die ends in a one to five after however
+    # many sixes, and the sixes are hits that add to the pool.
+    if ro6:
+        one, hit = 1 / 5., 1 / 4.
+        sixes = [(5 / 6.) ** pool]
+        k = 0
+        while pool and (k < pool or sixes[-1] > EPSILON):
+            sixes.append(sixes[-1] * (pool + k) / (k + 1) / 6.)
+            k += 1
+    else:
+        one, hit = 1 / 6., 2 / 5.
+        sixes = [1.0]
+    successes = [0.0] * (pool + len(sixes) + leftover)
+    critical = 0.0
+    glitch = 0.0
+    for n, p in enumerate(_binomial(pool, one)):
+        hits = _binomial(pool - n, hit)
+        for k, q in enumerate(sixes):
+            glitched = n > (pool + k + leftover) / 2.
+            if glitched:
+                glitch += p * q
+            for h, r in enumerate(hits):
+                h += k + leftover
+                if glitched and not h:
+                    critical += p * q * r
+                else:
+                    successes[h] += p * q * r
+    return Odds(successes, [("critical glitch", critical)],
+                [("glitch", glitch)], noun='hits')
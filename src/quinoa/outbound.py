@@ -0,0 +1,162 @@
+"""
+Pacing for everything a bot sends, so bursts don't get it throttled or
+kicked by the server.
+"""
+
+import threading
+from collections import deque, OrderedDict
+import xmppony as xmpp
+from scheduler import clock
+
+class TokenBucket(object):
+    """
+    Allows rate events a second on average, and bursts of up to burst.
+    """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = clock()
+    def __refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+    def wait(self, now):
+        """Seconds until a token is available."""
+        self.__refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+    def take(self, now):
+        self.__refill(now)
+        self.tokens -= 1
+    def full(self, now):
+        self.__refill(now)
+        return self.tokens >= self.burst
+
+class _Text(object):
+    """Replies to one destination waiting to go out as one message."""
+    __slots__ = ('to', 'type', 'texts', 'since')
+    def __init__(self, to, type, text, since):
+        self.to = to
+        self.type = type
+        self.texts = [text]
+        self.since = since
+    def stanza(self):
+        return xmpp.protocol.Message(self.to, '\n'.join(self.texts), self.type)
+
+class Outbox(object):
+    """
+    A queue of outgoing stanzas.
+
+    Messages are paced by a token bucket per destination and one for the
+    whole bot.  Replies queued with put_text wait window seconds, and any
+    further replies to the same destination in that time, or while it's
+    being held back by its rate limit, go out with them as one message.
+    Other stanzas, like presence, aren't limited and go out first.
+
+    put and put_text are safe to call from any thread; flush and wait
+    belong to the serve loop.  If observe is set, flush calls it with the
+    seconds each reply queued with put_text spent waiting.
+    """
+    def __init__(self, window=0.1, rate=1.0, burst=5, global_rate=10.0,
+                 global_burst=20):
+        self.window = window
+        self.rate = rate
+        self.burst = burst
+        self._global = TokenBucket(global_rate, global_burst)
+        self._lock = threading.Lock()
+        self._urgent = deque()
+        self._queues = OrderedDict() # destination -> deque of entries
+        self._buckets = {}
+        self.observe = None
+    def __len__(self):
+        return self.depth()
+    def depth(self):
+        """How many stanzas are waiting to go out."""
+        with self._lock:
+            return len(self._urgent) + \
+                    sum(len(q) for q in self._queues.itervalues())
+    def put(self, stanza):
+        """Queue a stanza to be sent as it is."""
+        with self._lock:
+            if stanza.getName() != 'message':
+                self._urgent.append(stanza)
+                return
+            to = unicode(stanza.getTo())
+            self._queues.setdefault(to, deque()).append(stanza)
+    def put_text(self, to, text, type):
+        """Queue a reply, merging it with any others still waiting."""
+        key = unicode(to)
+        now = clock()
+        with self._lock:
+            queue = self._queues.setdefault(key, deque())
+            if queue:
+                last = queue[-1]
+                if isinstance(last, _Text) and last.type == type:
+                    last.texts.append(text)
+                    return
+            queue.append(_Text(to, type, text, now))
+    def __bucket(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+        return bucket
+    def __hold(self, key, queue, now):
+        """Seconds until the head of queue may go out."""
+        hold = self.__bucket(key).wait(now)
+        head = queue[0]
+        if isinstance(head, _Text):
+            hold = max(hold, head.since + self.window - now)
+        return hold
+    def wait(self):
+        """
+        Seconds until flush would send something, or None if there's
+        nothing queued.
+        """
+        now = clock()
+        with self._lock:
+            if self._urgent:
+                return 0
+            if not self._queues:
+                return None
+            wait = min(self.__hold(key, queue, now)
+                       for key, queue in self._queues.iteritems())
+            return max(0, wait, self._global.wait(now))
+    def flush(self, send):
+        """Pass every stanza that may go out now to send."""
+        now = clock()
+        out = []
+        waits = []
+        with self._lock:
+            while self._urgent:
+                out.append(self._urgent.popleft())
+            progress = True
+            # One stanza per destination per pass, so busy rooms can't
+            # starve quiet ones of the global allowance.
+            while progress and self._global.wait(now) == 0:
+                progress = False
+                for key in self._queues.keys():
+                    if self._global.wait(now) > 0:
+                        break
+                    queue = self._queues[key]
+                    if self.__hold(key, queue, now) > 0:
+                        continue
+                    entry = queue.popleft()
+                    self._buckets[key].take(now)
+                    self._global.take(now)
+                    if isinstance(entry, _Text):
+                        waits.append(now - entry.since)
+                        entry = entry.stanza()
+                    out.append(entry)
+                    progress = True
+                    if not queue:
+                        del self._queues[key]
+            for key in self._buckets.keys():
+                if key not in self._queues and self._buckets[key].full(now):
+                    del self._buckets[key]
+        for stanza in out:
+            send(stanza)
+        if self.observe is not None:
+            for wait in waits:
+                self.observe(wait)
@@ -0,0 +1,100 @@
+"""
+Commands from other packages, found through setuptools entry points.
+
+A package offers commands in its setup.py:
+
+    entry_points={
+        'quinoa.commands': [
+            'fortune = mypack.fortune:fortune',
+            r're:(?i)tell me a (joke|story)$ = mypack.jokes:tell',
+        ],
+    },
+
+where each is a function taking (bot, msg), or (bot, msg, match) if it is
+decorated with quinoa.takes_match.  A name like fortune is matched as the
+first word, capitalised or not ([Ff]ortune\\b); a name starting with re: is
+a regex of its own.  A command's module isn't imported until a message
+first matches it.  One that can't be imported then answers with the error,
+as any command that raises does.
+"""
+
+import re
+import threading
+
+GROUP = 'quinoa.commands'
+
+def pattern_of(name):
+    """The regex an entry point name stands for."""
+    if name.startswith('re:'):
+        return name[3:]
+    first = name[0]
+    if first.isalpha():
+        return r'[%s%s]%s\b' % (first.upper(), first.lower(),
+                                re.escape(name[1:]))
+    return re.escape(name) + r'\b'
+
+class LazyCommand(object):
+    """
+    Stands in for the command an entry point names, and imports it the first
+    time it's called.  Always takes the match; passes it on if the command
+    wants it.
+    """
+    takes_match = True
+    def __init__(self, entry_point, bot):
+        self.entry_point = entry_point
+        self.bot = bot
+        self.__name__ = '.'.join(entry_point.attrs) or entry_point.name
+        self._fn = None
+        self._lock = threading.Lock()
+    def load(self):
+        """The command itself, importing it if need be."""
+        if self._fn is None:
+            with self._lock:
+                if self._fn is None:
+                    entry_point = self.entry_point
+                    if hasattr(entry_point, 'resolve'):
+                        self._fn = entry_point.resolve()
+                    else:
+                        self._fn = entry_point.load(require=False)
+        return self._fn
+    @property
+    def loaded(self):
+        return self._fn is not None
+    # Bot.help reads __doc__, so it has to come from the command.
+    @property
+    def __doc__(self):
+        try:
+            return self.load().__doc__
+        except ImportError, e:
+            return "Couldn't load %s: %s" % (self.entry_point.name, e)
+    def __call__(self, msg, match=None):
+        fn = self.load()
+        if getattr(fn, 'takes_match', False):
+            return fn(self.bot, msg, match)
+        return fn(self.bot, msg)
+    def __repr__(self):
+        return "<LazyCommand %s>" % self.entry_point
+
+def entry_points(group=GROUP, dists=None):
+    """
+    Every entry point in group, from every installed distribution, or only
+    from dists.  Each of dists is a distribution, or the project name of an
+    installed one.
+    """
+    names = None
+    found = []
+    if dists is not None:
+        names = set()
+        for dist in dists:
+            if isinstance(dist, basestring):
+                names.add(dist)
+            else:
+                entry_map = dist.get_entry_map(group)
+                found.extend(entry_map[name] for name in sorted(entry_map))
+    if names is None or names:
+        import pkg_resources
+        for entry_point in pkg_resources.iter_entry_points(group):
+            if names is None or (entry_point.dist is not None and
+                    entry_point.dist.project_name in names):
+                found.append(entry_point)
+    return found
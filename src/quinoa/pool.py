@@ -0,0 +1,107 @@
+"""
+Serving many bots from one process.
+"""
+
+import sys
+import errno
+import select
+import signal
+import socket
+from scheduler import Scheduler, earliest
+
+class BotPool(object):
+    """
+    Serves any number of bots from a single thread, waiting on all their
+    sockets at once.  The bots share one scheduler, and bots of the same
+    class share their compiled command tables, so each extra account costs
+    little more than its connection.
+
+    Add bots before calling serve(), which runs until self._finished is True
+    or every bot has finished.  A bot that can't connect, or loses its
+    connection, is reconnected with backoff while the rest carry on.
+    """
+    def __init__(self, bots=(), log=None):
+        if getattr(log, 'write', False):
+            self.__log = log
+        else:
+            self.__log = sys.stdout
+        self.scheduler = Scheduler(on_error=self.__job_failed)
+        self.bots = []
+        self._finished = False
+        for bot in bots:
+            self.add(bot)
+    def log(self, text):
+        self.__log.write("%s: %s\n" % (self.__class__.__name__, text))
+    def __job_failed(self, job, e):
+        self.log("Scheduled %s failed: %s" % (job, e))
+    def add(self, bot):
+        bot.scheduler = self.scheduler
+        self.bots.append(bot)
+    def remove(self, bot):
+        self.bots.remove(bot)
+        bot.stop()
+    def __lost(self, bot, delay=None):
+        bot.disconnect()
+        wait, delay = bot.reconnect_backoff(delay)
+        self.log("Reconnecting %s in %.1fs." % (bot.jid, wait))
+        self.scheduler.schedule_in(wait, self.__reconnect, bot, delay)
+    def __reconnect(self, bot, delay):
+        if bot in self.bots and not bot._finished and not bot.start():
+            self.__lost(bot, delay)
+    def toggle_profiling(self, *args):
+        for bot in self.bots:
+            bot.toggle_profiling()
+    def serve(self):
+        """
+        Connect every bot, and serve them all until self._finished is True.
+        SIGUSR1 toggles profiling on every bot.
+        """
+        if hasattr(signal, 'SIGUSR1'):
+            try:
+                signal.signal(signal.SIGUSR1, self.toggle_profiling)
+            except ValueError:
+                pass # Not the main thread.
+        for bot in self.bots:
+            if not bot.start():
+                self.__lost(bot)
+        while not self._finished and self.bots:
+            for bot in [b for b in self.bots if b._finished]:
+                self.remove(bot)
+            try:
+                timeout = self.scheduler.timeout()
+                sockets = {}
+                for bot in self.bots:
+                    if bot.conn is None:
+                        continue
+                    try:
+                        bot.flush()
+                    except (IOError, socket.error), e:
+                        self.log("%s lost its connection: %s" % (bot.jid, e))
+                        self.__lost(bot)
+                        continue
+                    timeout = earliest(timeout, bot.timeout())
+                    sockets[bot.fileno()] = bot
+                try:
+                    readable = select.select(sockets.keys(), [], [],
+                                             timeout)[0]
+                except select.error, e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    readable = []
+                for fd in readable:
+                    bot = sockets[fd]
+                    try:
+                        bot.pump()
+                    except (IOError, socket.error), e:
+                        self.log("%s lost its connection: %s" % (bot.jid, e))
+                        self.__lost(bot)
+                self.scheduler.run_pending()
+                for bot in self.bots:
+                    bot.handle_signals()
+                    if bot.conn is not None and bot.is_dead():
+                        self.log("%s stopped answering pings." % bot.jid)
+                        self.__lost(bot)
+            except KeyboardInterrupt:
+                break
+        for bot in self.bots:
+            bot.stop()
@@ -0,0 +1,73 @@
+"""
+Profiling a running bot, a window at a time.
+"""
+
+import os
+import time
+import pstats
+import cProfile
+import threading
+
+class Profiler(object):
+    """
+    Collects cProfile runs of individual calls, from any thread, into one
+    set of statistics.  While it isn't active, runcall costs one attribute
+    check.
+
+    A call made from inside another profiled call, on the same thread, is
+    already being profiled and isn't profiled again.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = None
+        self.active = False
+        self.started = None
+        self.calls = 0
+    def start(self):
+        """Throw away anything collected, and start collecting."""
+        with self._lock:
+            self._stats = None
+            self.calls = 0
+            self.started = time.time()
+            self.active = True
+    def stop(self):
+        """Stop collecting, and return the statistics, or None if empty."""
+        with self._lock:
+            self.active = False
+            return self._stats
+    def runcall(self, fn, *args):
+        """Call fn(*args), profiling it if we're active."""
+        if not self.active or getattr(self._local, 'busy', False):
+            return fn(*args)
+        profile = cProfile.Profile()
+        self._local.busy = True
+        try:
+            return profile.runcall(fn, *args)
+        finally:
+            self._local.busy = False
+            self.__add(profile)
+    def __add(self, profile):
+        with self._lock:
+            if not self.active:
+                return
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self.calls += 1
+    def write(self, stats, directory, name, limit=50):
+        """
+        Write stats to directory as name.prof, for pstats or a viewer, and
+        name.txt, the top limit functions by cumulative and by own time.
+        Returns the path of the text report.
+        """
+        base = os.path.join(directory, name)
+        stats.dump_stats(base + '.prof')
+        with open(base + '.txt', 'w') as f:
+            f.write("%d calls profiled from %s to %s.\n" % (
+                    self.calls, time.ctime(self.started), time.ctime()))
+            stats.stream = f
+            stats.sort_stats('cumulative').print_stats(limit)
+            stats.sort_stats('time').print_stats(limit)
+        return base + '.txt'
@@ -6,11 +6,42 @@ Framework for room-aware jabber bots.
 
 import os
 import sys
-import xmppony as xmpp
 import time
+import errno
+import random
+import select
+import signal
+import socket
+import xmppony as xmpp
 # NOTE: RegDict is a dangerous evil thing. It is probably not a good thing to
 # use.
-from regdict import RegDict
+from regdict import CompiledRegDict
+from scheduler import Scheduler, earliest, clock
+from executor import Executor
+from outbound import Outbox
+from muc import JoinManager
+from stats import Stats
+from profiling import Profiler
+from plugins import LazyCommand, entry_points, pattern_of, GROUP
+
+def takes_match(method):
+    """
+    Decorate a command method to have it called as (self, msg, match), where
+    match is the match object of the command's regex against the message
+    body, so the method needn't parse the body again.
+    """
+    method.takes_match = True
+    return method
+
+NS_PING = 'urn:xmpp:ping'
+
+def _command_name(handler):
+    return getattr(handler, '__name__', None) or repr(handler)
+
+def _is_delayed(msg):
+    """Is msg marked as delivered late, with XEP-0203 or XEP-0091 delay?"""
+    return msg.getTag('delay', namespace='urn:xmpp:delay') is not None or \
+            msg.getTag('x', namespace='jabber:x:delay') is not None
 
 class Bot(object):
     """
@@ -18,10 +49,54 @@ class Bot(object):
 
     To add commands to the bot, add methods with a signature of (self, msg).
     Then, in the derived class's implementation of register_commands, assign
-    that method to a regex-string key in self.commands.
+    that method to a regex-string key in self.commands.  Methods decorated
+    with takes_match get the regex's match object as well.
     """
+    # How many recent message bodies to remember the command lookup for.
+    command_cache_size = 1024
+    # Seconds between periodic_actions.
+    periodic_interval = 10
+    # After ping_interval seconds without hearing from the server, we ping
+    # it; if ping_timeout more pass in silence, the connection is dead.
+    ping_interval = 60
+    ping_timeout = 20
+    # A lost connection is retried after reconnect_delay seconds, doubling
+    # each failure up to max_reconnect_delay, give or take half.
+    reconnect_delay = 1
+    max_reconnect_delay = 120
+    # With workers, commands run on that many threads instead of in the serve
+    # loop, one at a time per room or person, and are abandoned after
+    # handler_timeout seconds.
+    workers = 0
+    handler_timeout = 30
+    # Presence priority; the server delivers messages sent to our bare JID to
+    # the connected resource with the highest non-negative priority.
+    priority = None
+    # (host, port) to connect to, instead of looking up the JID's server.
+    server = None
+    # How often the serve loop checks for replies while commands are running.
+    busy_poll_interval = 0.05
+    # Outgoing messages are limited to send_rate a second to each room or
+    # person, with bursts of send_burst, and to global_send_rate a second
+    # overall.  Replies to the same place within coalesce_window seconds
+    # are sent as one message.
+    coalesce_window = 0.1
+    send_rate = 1.0
+    send_burst = 5
+    global_send_rate = 10.0
+    global_send_burst = 20
+    # If stats_file is set, the Prometheus text exposition of self.stats is
+    # written there every stats_interval seconds.
+    stats_file = None
+    stats_interval = 15
+    # Bare JIDs allowed to use admin commands, like profile, in private.
+    admins = ()
+    # Profiling runs for profile_window seconds unless stopped sooner, and
+    # writes its reports to profile_dir.  profile_signal toggles it too.
+    profile_window = 60
+    profile_dir = '.'
+    profile_signal = getattr(signal, 'SIGUSR1', None)
     def __init__(self, jid, resource=None, password=None, log=None):
-        self.__last = int(time.strftime('%s', time.localtime()))
         if getattr(log, 'write', False):
             self.__log = log
         else:
@@ -30,19 +105,37 @@ class Bot(object):
         self.resource = resource or self.__class__.__name__
         self.password = password
         self.rooms = {}
+        self.autojoin = [] # room@service JIDs to join once connected
+        self.joins = JoinManager(self.send, self.__joined, self.__join_failed)
         self.conn = None
         self._finished = False
-        self.commands = RegDict() # dict of str -> self.method
+        self.last_heard = None
+        self.__rejoin = []
+        self.scheduler = Scheduler(on_error=self.__job_failed)
+        self.executor = None
+        self.__jobs = []
+        self.outbox = Outbox(self.coalesce_window, self.send_rate,
+                             self.send_burst, self.global_send_rate,
+                             self.global_send_burst)
+        self.stats = Stats()
+        self.outbox.observe = self.__observe_outbox
+        self.profiler = Profiler()
+        self.__profile_job = None
+        self.__profile_toggle = False
+        # dict of str -> self.method
+        self.commands = CompiledRegDict(cache_size=self.command_cache_size)
         self.commands[r'[Jj]oin\b'] = self.join
         self.commands[r'[Ll]eave\b'] = self.leave
         self.commands[r'[Hh]elp\b'] = self.help
+        self.commands[r'[Ss]tats\b'] = self.show_stats
+        self.commands[r'[Pp]rofile\b'] = self.profile
         self.register_commands()
     def log(self, text):
         """
         Send a message to the specified logging service, or stdout
         otherwise.
         """
-        self.__log.write("%s: %s" % (self.__class__.__name__, text))
+        self.__log.write("%s: %s\n" % (self.__class__.__name__, text))
     def register_commands(self):
         """
         Implement this method to associate regex-string commands with
@@ -51,6 +144,26 @@ class Bot(object):
         This method MUST be implemented.
         """
         raise NotImplementedError
+    def load_plugins(self, group=GROUP, dists=None):
+        """
+        Register every command offered under the entry point group, by its
+        regex, without importing any of them yet; see quinoa.plugins.  With
+        dists, only those distributions' commands are used; they may be
+        distributions or project names.  Call this from register_commands;
+        commands registered before it win.  Returns how many were added.
+        """
+        added = 0
+        # RegDict's `in` matches text against the regexes; we want the
+        # regexes themselves.
+        taken = set(kt[1] for kt in self.commands.keys())
+        for entry_point in entry_points(group, dists):
+            pattern = pattern_of(entry_point.name)
+            if pattern in taken:
+                continue
+            taken.add(pattern)
+            self.commands[pattern] = LazyCommand(entry_point, self)
+            added += 1
+        return added
     def on_connect(self):
         """
         Implement this method to define actions to perform right after
@@ -64,58 +177,321 @@ class Bot(object):
         fashion.
         """
         pass
+    def schedule_in(self, delay, fn, *args):
+        """
+        Call fn(*args) once, delay seconds from now.  Returns a job with a
+        cancel() method.
+        """
+        return self.scheduler.schedule_in(delay, fn, *args)
+    def schedule_at(self, when, fn, *args):
+        """
+        Call fn(*args) once, at when, in seconds since the epoch.  Returns a
+        job with a cancel() method.
+        """
+        return self.scheduler.schedule_at(when, fn, *args)
+    def schedule_every(self, interval, fn, *args):
+        """
+        Call fn(*args) every interval seconds while serving.  Returns a job
+        with a cancel() method.
+        """
+        return self.scheduler.schedule_every(interval, fn, *args)
+    def __job_failed(self, job, e):
+        self.log("Scheduled %s failed: %s" % (job, e))
+    def __command_failed(self, e):
+        self.log("Command failed: %s" % e)
+    def send(self, stanza):
+        """
+        Queue a stanza to be sent from the serve loop.  Commands should send
+        through this rather than self.conn, as it is safe from any thread.
+        """
+        self.outbox.put(stanza)
+    def flush(self):
+        """Send whatever the outbox will let out now."""
+        self.outbox.flush(self.__write)
+    def __write(self, stanza):
+        started = clock()
+        self.conn.send(stanza)
+        self.stats.observe('send_seconds', None, clock() - started)
+    def __observe_outbox(self, wait):
+        self.stats.observe('outbox_wait_seconds', None, wait)
+    def __write_stats(self):
+        self.stats.write(self.stats_file)
     def __callback_presence(self, conn, msg):
+        if self.joins.handle(msg):
+            return
         presence_type = msg.getType()
         if presence_type == 'subscribe':
             who = msg.getFrom()
-            self.conn.send(xmpp.protocol.Presence(to=who, typ='subscribed'))
-            self.conn.send(xmpp.protocol.Presence(to=who, typ='subscribe'))
+            self.send(xmpp.protocol.Presence(to=who, typ='subscribed'))
+            self.send(xmpp.protocol.Presence(to=who, typ='subscribe'))
+    def __callback_ping(self, conn, iq):
+        self.send(iq.buildReply('result'))
+        raise xmpp.NodeProcessed
+    def make_client(self):
+        """
+        A new, unconnected client for our server.  Override to connect
+        through something else, like quinoa.testing.FakeClient.
+        """
+        return xmpp.client.Client(self.jid.getDomain(), debug=[])
     def __connect(self):
         if not self.conn:
-            conn = xmpp.client.Client(self.jid.getDomain(), debug=[])
-            if not conn.connect():
-                self.log('Unable to connect.')
-                return None
-            if not conn.auth(self.jid.getNode(), self.password, self.resource):
-                self.log('Unable to authorize.')
+            conn = self.make_client()
+            try:
+                if not conn.connect(self.server):
+                    self.log('Unable to connect.')
+                    return None
+                if not conn.auth(self.jid.getNode(), self.password,
+                                 self.resource):
+                    self.log('Unable to authorize.')
+                    return None
+            except (IOError, socket.error), e:
+                self.log('Unable to connect: %s' % e)
                 return None
             conn.RegisterHandler('message', self.__callback_message)
             conn.RegisterHandler('presence', self.__callback_presence)
-            conn.sendInitPresence()
+            conn.RegisterHandler('iq', self.__callback_ping, typ='get',
+                                 ns=NS_PING)
+            if self.priority is None:
+                conn.sendInitPresence()
+            else:
+                conn.send(self.__presence())
             self.conn = conn
+            self.last_heard = clock()
             self.on_connect()
+            # Rooms we were in before losing the connection are all asked
+            # for again at once, along with the ones we always join.
+            rooms = list(self.autojoin)
+            rooms.extend(room for room in self.__rejoin if room not in rooms)
+            self.__rejoin = []
+            for room in rooms:
+                self.join_room(room)
         return self.conn
-    def __idle_process(self):
-        time.sleep(1)
-        now = int(time.strftime('%s', time.localtime()))
-        delta = now - self.__last
-        if delta > 60:
-            self.__last = now
-            self.conn.send(xmpp.protocol.Presence())
-        if delta % 10 == 0:
-            self.periodic_action()
+    def __presence(self):
+        if self.priority is None:
+            return xmpp.protocol.Presence()
+        return xmpp.protocol.Presence(priority=self.priority)
+    def __ping(self):
+        if clock() - self.last_heard >= self.ping_interval:
+            iq = xmpp.protocol.Iq('get', to=self.jid.getDomain())
+            iq.setTag('ping', namespace=NS_PING)
+            self.send(iq)
+    def is_dead(self):
+        """
+        Has the server been silent for longer than a ping should take to be
+        answered?
+        """
+        return self.conn is None or \
+                clock() - self.last_heard > self.ping_interval + \
+                self.ping_timeout
+    def process(self, timeout=0):
+        """
+        Wait up to timeout seconds for a stanza, and handle whatever has
+        arrived.  Returns True if anything did.  Raises IOError when the
+        connection has been lost.
+        """
+        result = self.conn.Process(timeout)
+        # The dispatcher returns '0' when nothing arrived in time, and 0 or
+        # None once the stream has closed; it swallows the IOError itself.
+        if result == '0':
+            return False
+        if not result:
+            raise IOError, "Connection closed by server."
+        self.last_heard = clock()
+        return True
+    def timeout(self):
+        """
+        Seconds until the bot needs to flush its outbox or check on running
+        commands, or None.  Scheduled jobs aren't included.
+        """
+        timeout = None
+        # Check the executor first: a command queues its reply before it
+        # stops being busy.
+        if self.executor is not None and self.executor.busy():
+            timeout = self.busy_poll_interval
+        return earliest(timeout, self.outbox.wait())
+    def fileno(self):
+        """The connection's socket, for select()."""
+        return self.conn.Connection._sock.fileno()
+    def pump(self):
+        """Handle every stanza that has arrived, without waiting for more."""
+        self.profiler.runcall(self.__pump)
+    def __pump(self):
+        while self.process(0):
+            pass
+    def is_admin(self, msg):
+        """Did msg come, as a private message, from one of self.admins?"""
+        if msg.getType() == 'groupchat':
+            return False
+        return msg.getFrom().getStripped() in self.admins
+    def start_profiling(self, window=None):
+        """
+        Profile commands and the serve loop for window seconds, or
+        profile_window.
+        """
+        if self.__profile_job is not None:
+            self.__profile_job.cancel()
+        self.profiler.start()
+        self.__profile_job = self.schedule_in(window or self.profile_window,
+                                              self.stop_profiling)
+    def stop_profiling(self):
+        """
+        Stop profiling and write the report to profile_dir.  Returns its
+        path, or None if nothing was profiled.
+        """
+        if self.__profile_job is not None:
+            self.__profile_job.cancel()
+            self.__profile_job = None
+        stats = self.profiler.stop()
+        if stats is None:
+            return None
+        name = "profile-%s-%s" % (self.resource,
+                                  time.strftime('%Y%m%d-%H%M%S'))
+        path = self.profiler.write(stats, self.profile_dir, name)
+        self.log("Wrote profile to %s" % path)
+        return path
+    def toggle_profiling(self, *args):
+        """
+        Start profiling, or stop if we are.  This only sets a flag for the
+        serve loop, so it is safe to use as a signal handler.
+        """
+        self.__profile_toggle = True
+    def handle_signals(self):
+        """
+        Act on whatever signal handlers have asked for.  serve() calls this
+        each time round its loop.
+        """
+        if self.__profile_toggle:
+            self.__profile_toggle = False
+            if self.profiler.active:
+                self.stop_profiling()
+            else:
+                self.start_profiling()
+    def start(self):
+        """
+        Connect, and get ready to serve.  Returns False if we couldn't
+        connect.  serve() does this for you.
+        """
+        if not self.__connect():
+            return False
+        if self.workers:
+            self.executor = Executor(self.workers, self.handler_timeout,
+                                     on_error=self.__command_failed)
+            self.executor.start()
+        self.__jobs = [
+            self.schedule_every(min(self.ping_interval, self.ping_timeout),
+                                self.__ping),
+            self.schedule_every(self.periodic_interval, self.periodic_action),
+        ]
+        if self.stats_file:
+            self.__jobs.append(self.schedule_every(self.stats_interval,
+                                                   self.__write_stats))
+        return True
+    def __halt(self):
+        for job in self.__jobs:
+            job.cancel()
+        self.__jobs = []
+        if self.executor is not None:
+            self.executor.stop()
+            self.executor = None
+    def stop(self):
+        """Undo start(), once serving is over."""
+        self.__halt()
+        if self.conn is not None:
+            self.flush()
+    def disconnect(self):
+        """
+        Give up on a lost connection.  The next start() reconnects, rejoins
+        every room we were in, and sends whatever is left in the outbox.
+        """
+        self.__halt()
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            try:
+                conn.Connection._sock.close()
+            except Exception:
+                pass
+        for room in self.rooms.keys() + self.joins.reset():
+            if room not in self.__rejoin:
+                self.__rejoin.append(room)
+        self.rooms = {}
+    def reconnect_backoff(self, delay):
+        """
+        Seconds to wait before the next connection attempt, and the delay to
+        pass in after that, given the last delay (or None for the first).
+        """
+        if delay is None:
+            delay = self.reconnect_delay
+        else:
+            delay = min(delay * 2, self.max_reconnect_delay)
+        return delay * random.uniform(0.5, 1.5), delay
     def serve(self):
         """
         Call this method to connect and begin serving until self._finished
         is True.
+
+        Between scheduled jobs, the bot waits in select() on its socket, so
+        it answers as soon as a stanza arrives and uses no CPU while idle.
+        If the connection is lost, or can't be made, the bot keeps trying
+        to reconnect.
         """
-        conn = self.__connect()
-        if not conn:
-            return
+        if self.profile_signal is not None:
+            try:
+                signal.signal(self.profile_signal, self.toggle_profiling)
+            except ValueError:
+                pass # Not the main thread.
+        delay = None
         while not self._finished:
             try:
-                conn.Process(1)
-                self.__idle_process()
+                if self.start():
+                    started = clock()
+                    try:
+                        self.__serve_connection()
+                    except (IOError, socket.error, select.error), e:
+                        self.log("Lost connection: %s" % e)
+                        self.disconnect()
+                    # Only a connection that stayed up a while starts the
+                    # backoff over, so a flapping server isn't hammered.
+                    if clock() - started > self.max_reconnect_delay:
+                        delay = None
+                if not self._finished:
+                    wait, delay = self.reconnect_backoff(delay)
+                    self.log("Reconnecting in %.1fs." % wait)
+                    time.sleep(wait)
             except KeyboardInterrupt:
                 break
+        self.stop()
         return
-    def help(self, msg):
-        """This provides help, duh."""
-        args = msg.getBody()
+    def __serve_connection(self):
+        while not self._finished:
+            self.handle_signals()
+            try:
+                self.profiler.runcall(self.__turn)
+            except select.error, e:
+                # A signal, like profile_signal, interrupted the wait.
+                if e.args[0] != errno.EINTR:
+                    raise
+            if self.is_dead():
+                raise IOError, "No answer to ping in %gs." % self.ping_timeout
+    def __turn(self):
+        self.flush()
+        self.process(earliest(self.scheduler.timeout(), self.timeout()))
+        self.scheduler.run_pending()
+    def _args(self, msg, match=None):
+        """
+        Return the body of msg after the command, using match if we have it.
+        """
+        text = msg.getBody()
+        if match is not None:
+            return text[match.end():].strip()
         try:
-            cmd, args = args.split(None, 1)
+            cmd, args = text.split(None, 1)
         except:
-            cmd, args = args, ''
+            args = ''
+        return args
+    @takes_match
+    def help(self, msg, match=None):
+        """This provides help, duh."""
+        args = self._args(msg, match)
         if not args:
             command_list = []
             for kt in self.commands.keys():
@@ -127,54 +503,57 @@ class Bot(object):
             return "Available commands: \n" + \
                 "\n".join(" * " + x for x in sorted(command_list)) + \
                 "\nRun 'help command' for more information on any command."
-        if args in self.commands:
-            ret = self.commands[args].__doc__
-            return ret
+        handler, m = self.commands.resolve(args)
+        if handler is not None:
+            return handler.__doc__
         return "No such command."
-    def join(self, msg):
+    @takes_match
+    def join(self, msg, match=None):
         """Usage: join room@service"""
-        args = msg.getBody()
-        try:
-            cmd, args = args.split(None, 1)
-        except:
-            cmd, args = args, ''
+        args = self._args(msg, match)
         try:
             room, serv = args.split('@')
         except:
             return """Usage: join room@service"""
-        self.joining = self.__join(room, serv, self.resource)
-        name = self.joining.next()
-        self.log(name)
+        self.join_room(args)
         return "Will attempt to join.  See you there."
-    def __listen_for_error(self, conn, msg):
-        presence_type = msg.getType()
+    def show_stats(self, msg):
+        """How often each command runs, and how long it takes."""
+        return "%s\nOutbox: %d waiting." % (self.stats.summary(),
+                                            self.outbox.depth())
+    @takes_match
+    def profile(self, msg, match=None):
+        """Usage: profile [seconds|stop] -- for admins only"""
+        if not self.is_admin(msg):
+            return "Only admins can do that."
+        args = self._args(msg, match)
+        if args == 'stop':
+            if not self.profiler.active:
+                return "Not profiling."
+            path = self.stop_profiling()
+            if path is None:
+                return "Nothing was profiled."
+            return "Wrote %s" % path
         try:
-            if presence_type == 'error' and msg.getErrorCode() == '409':
-                self.joining.send(False)
-            else:
-                self.joining.send(True)
-        except StopIteration:
-            pass
-    def __join(self, roomname, server, resource):
-        self.conn.RegisterHandler('presence', self.__listen_for_error)
-        while True:
-            room_to_join = xmpp.protocol.JID(node=roomname,
-                                             domain=server,
-                                             resource=resource)
-            self.conn.send(xmpp.protocol.Presence(to=room_to_join))
-            no_error = (yield)
-            if no_error:
-                break
-            resource += '_'
-        self.conn.RegisterHandler('presence', self.__callback_presence)
-        self.rooms[roomname + "@" + server] = resource
-    def leave(self, msg):
+            window = float(args) if args else self.profile_window
+        except ValueError:
+            return "Usage: profile [seconds|stop]"
+        self.start_profiling(window)
+        return "Profiling for %gs." % window
+    def join_room(self, room):
+        """
+        Join room, given as room@service.  This doesn't wait for the room to
+        answer, so joining many rooms at once is fine.
+        """
+        self.joins.join(room, self.resource)
+    def __joined(self, room, nick):
+        self.rooms[room] = nick
+    def __join_failed(self, room, reason):
+        self.log("Couldn't join %s: %s" % (room, reason))
+    @takes_match
+    def leave(self, msg, match=None):
         """Usage: leave room@service"""
-        args = msg.getBody()
-        try:
-            cmd, args = args.split(None, 1)
-        except:
-            cmd, args = args, ''
+        args = self._args(msg, match)
         try:
             room, serv = args.split('@')
         except:
@@ -182,17 +561,42 @@ class Bot(object):
         self.__leave(room, serv)
         return "Left."
     def __leave(self, roomname, server):
+        self.joins.cancel(roomname + "@" + server)
         room_to_leave = xmpp.protocol.JID(node=roomname,
                     domain=server,
                     resource=self.rooms[roomname + "@" + server])
-        self.conn.send(xmpp.protocol.Presence(to=room_to_leave,
+        self.send(xmpp.protocol.Presence(to=room_to_leave,
                     typ='unavailable',
                     status='So long, and thanks for all the dice?'))
         self.rooms.pop(roomname + "@" + server)
     def _send(self, to_jid, text, type):
         if type == 'groupchat':
             to_jid.setResource('')
-        self.conn.send(xmpp.protocol.Message(to_jid, text, type))
+        self.outbox.put_text(to_jid, text, type)
+    def __conversation(self, msg):
+        """The room, or else the person, msg belongs to."""
+        frm = msg.getFrom()
+        if msg.getType() == 'groupchat':
+            return frm.getStripped()
+        return unicode(frm)
+    def __call(self, handler, msg, match, queued=None):
+        name = _command_name(handler)
+        started = clock()
+        if queued is not None:
+            self.stats.observe('queue_wait_seconds', name, started - queued)
+        self.stats.count('commands_total', name)
+        try:
+            if getattr(handler, 'takes_match', False):
+                return self.profiler.runcall(handler, msg, match)
+            return self.profiler.runcall(handler, msg)
+        except Exception, e:
+            self.stats.count('command_errors_total', name)
+            return "Bad command: %s" % e
+        finally:
+            self.stats.observe('handler_seconds', name, clock() - started)
+    def __reply(self, msg, reply):
+        if reply:
+            self._send(msg.getFrom(), reply, msg.getType())
     def __callback_message(self, conn, msg):
         for node in msg.getChildren():
             if node.getAttr('xmlns') == "http://jabber.org/protocol/muc#user" \
@@ -202,6 +606,9 @@ class Bot(object):
                 self_msg = xmpp.protocol.Message()
                 self_msg.setBody("join %s@%s" % (roomname, servicename))
                 return self.join(self_msg)
+        if _is_delayed(msg):
+            # Room history or offline storage, not something said just now.
+            return
         text = msg.getBody()
         if msg.getType() == 'groupchat':
             fromroom = msg.getFrom()
@@ -211,14 +618,21 @@ class Bot(object):
                 return
         if not text:
             return
-        command = text
-        if command in self.commands:
-            try:
-                reply = self.commands[command](msg)
-            except Exception, e:
-                reply = "Bad command: %s" % e
-            if reply:
-                self._send(msg.getFrom(), reply, msg.getType())
+        started = clock()
+        handler, match = self.commands.resolve(text)
+        resolved = clock()
+        if handler is None:
+            self.stats.observe('resolve_seconds', None, resolved - started)
+            return
+        self.stats.observe('resolve_seconds', _command_name(handler),
+                           resolved - started)
+        if self.executor is None:
+            return self.__reply(msg, self.__call(handler, msg, match))
+        self.executor.submit(self.__conversation(msg), self.__call,
+                (handler, msg, match, resolved),
+                done=lambda reply: self.__reply(msg, reply),
+                expired=lambda: self.__reply(msg,
+                                             "Sorry, that took too long."))
 
 if __name__ == "__main__":
     class TestBot(Bot):
@@ -3,6 +3,104 @@ This class is such a bad idea.
 """
 
 import re
+import weakref
+from lru import LRUCache
+
+# Flags a pattern compiles with when it carries no inline flags of its own.
+_PLAIN_FLAGS = re.compile('').flags
+# Python's re refuses more than 100 groups in one pattern.
+_MAX_GROUPS = 99
+# Longer keys are looked up without going through the cache.
+_MAX_CACHED_KEY = 256
+_backref = re.compile(r'\\[1-9]|\(\?\(')
+_toggle = re.compile(r'\[(\w)(\w)\]')
+_special = '.^$*+?{}[]\\|()'
+
+def _prefix(kt):
+    """
+    Return the case-folded literal text every match of this pattern must
+    start with, or '' if there isn't any.  A case toggle like [Rr] counts
+    as a literal.
+    """
+    rekey, source = kt
+    if rekey.flags & re.VERBOSE or '|' in source:
+        return ''
+    chars = []
+    i, n = 0, len(source)
+    if source.startswith('^'):
+        i = 1
+    while i < n:
+        c = source[i]
+        if c == '\\':
+            if i + 1 >= n or source[i + 1].isalnum():
+                break
+            lit, i = source[i + 1], i + 2
+        elif c == '[':
+            m = _toggle.match(source, i)
+            if not m or m.group(1).lower() != m.group(2).lower():
+                break
+            lit, i = m.group(1), m.end()
+        elif c in _special:
+            break
+        else:
+            lit, i = c, i + 1
+        if i < n and source[i] in '*?{':
+            break
+        chars.append(lit.lower())
+        if i < n and source[i] == '+':
+            break
+    return ''.join(chars)
+
+# Keys and indexes are shared between every RegDict with the same patterns,
+# so a hundred bots of one class compile and index their commands once.
+_kts = {} # source -> (compiled, source)
+_indexes = weakref.WeakValueDictionary() # tuple of keys -> _Index
+
+def _key(source):
+    kt = _kts.get(source)
+    if kt is None:
+        kt = _kts[source] = (re.compile(source), source)
+    return kt
+
+class _Index(object):
+    """
+    A trie of the keys' literal prefixes, and whatever else a RegDict with
+    these keys, in this order, wants to keep about them in self.matchers.
+    """
+    def __init__(self, kts):
+        trie = ({}, [])
+        unindexed = []
+        rank = {}
+        for i, kt in enumerate(kts):
+            rank[kt] = i
+            prefix = _prefix(kt)
+            if not prefix:
+                unindexed.append(kt)
+                continue
+            node = trie
+            for ch in prefix:
+                node = node[0].setdefault(ch, ({}, []))
+            node[1].append(kt)
+        self.unindexed = unindexed
+        self.rank = rank
+        self.trie = trie
+        self.matchers = {}
+    def candidates(self, key):
+        """
+        Return the keys that could match key, in registration order.
+        """
+        found = []
+        node = self.trie
+        for ch in key:
+            node = node[0].get(ch.lower())
+            if node is None:
+                break
+            found.extend(node[1])
+        if not found:
+            return self.unindexed
+        found.extend(self.unindexed)
+        found.sort(key=self.rank.__getitem__)
+        return found
 
 class RegDict(dict):
     """
@@ -10,26 +108,154 @@ class RegDict(dict):
     maches a regex as an index.  This is *not* O(1), just a mapping.
 
     This is a many-to-many mapping, if you're not careful.  If multiple regexes
-    match, which one will be used is not defined.  Don't be stupid.
+    match, the one registered first wins.
+
+    Patterns are indexed in a trie by their literal prefix, so a lookup only
+    tries the patterns whose prefix the key starts with, plus those that have
+    no literal prefix at all.
+
+    With a cache_size, the last cache_size lookups (misses included) are
+    remembered in self.cache, which is cleared whenever the keys change.
     """
+    def __init__(self, cache_size=0):
+        dict.__init__(self)
+        self._order = [] # keys in registration order
+        self._keys = {} # source -> (compiled, source)
+        self._index = None
+        self.cache = None
+        if cache_size:
+            self.cache = LRUCache(cache_size)
+    def _changed(self):
+        """Called whenever the set of keys changes."""
+        self._index = None
+        if self.cache is not None:
+            self.cache.clear()
+    def _get_index(self):
+        index = self._index
+        if index is None:
+            kts = tuple(self._order)
+            index = _indexes.get(kts)
+            if index is None:
+                index = _indexes[kts] = _Index(kts)
+            self._index = index
+        return index
+    def _lookup(self, key):
+        """Return the (compiled, source) key matching key, and its match."""
+        for kt in self._get_index().candidates(key):
+            m = kt[0].match(key)
+            if m:
+                return kt, m
+        return None, None
+    def _find(self, key):
+        cache = self.cache
+        if cache is None or len(key) > _MAX_CACHED_KEY:
+            return self._lookup(key)
+        found = cache.get(key)
+        if found is None:
+            found = cache[key] = self._lookup(key)
+        return found
+    def resolve(self, key):
+        """
+        Return the value for key and the match object of its regex, or
+        (None, None) if no regex matches, in a single scan.
+        """
+        kt, m = self._find(key)
+        if kt is None:
+            return None, None
+        return dict.__getitem__(self, kt), m
     def __contains__(self, key):
-        for kt, v in self.items():
-            k = kt[0]
-            if k.match(key):
-                return v
+        return self._find(key)[0] is not None
     def __getitem__(self, key):
-        for kt, v in self.items():
-            k = kt[0]
-            if k.match(key):
-                return v
+        kt, m = self._find(key)
+        if kt is not None:
+            return dict.__getitem__(self, kt)
     def __setitem__(self, key, value):
-        if isinstance(key, basestring):
-            rekey = re.compile(key)
-        else:
+        if not isinstance(key, basestring):
             raise KeyError, "Use only strings as keys"
-        dict.__setitem__(self, (rekey, key), value)
+        kt = self._keys.get(key)
+        if kt is None:
+            kt = self._keys[key] = _key(key)
+            self._order.append(kt)
+            self._changed()
+        dict.__setitem__(self, kt, value)
+    def __delitem__(self, key):
+        """Remove the entry registered under the regex-string key."""
+        kt = self._keys.pop(key)
+        self._order.remove(kt)
+        dict.__delitem__(self, kt)
+        self._changed()
+    def pop(self, key, *default):
+        if key not in self._keys:
+            if default:
+                return default[0]
+            raise KeyError, key
+        value = dict.__getitem__(self, self._keys[key])
+        del self[key]
+        return value
+    def clear(self):
+        dict.clear(self)
+        self._order = []
+        self._keys = {}
+        self._changed()
     def __unicode__(self):
         return "RegDict({%s})" % ', '.join("%s: %s" % (repr(kt[1]), v) \
                 for kt, v in self.items())
     __str__ = __unicode__
     __repr__ = __unicode__
+
+def _mergeable(kt):
+    """Can this pattern safely share an alternation with others?"""
+    rekey, source = kt
+    return rekey.flags == _PLAIN_FLAGS and not rekey.groupindex \
+            and not _backref.search(source)
+
+class CompiledRegDict(RegDict):
+    """
+    A RegDict that merges its patterns into one alternation of named groups,
+    so a lookup costs a single regex run however many keys there are.
+
+    Patterns with inline flags, named groups or backreferences can't share an
+    alternation, and are tried on their own in their place in the order.  One
+    set of matchers is built per distinct set of prefix-index candidates, and
+    they are rebuilt lazily after the keys change.
+    """
+    def _build(self, kts):
+        matchers = []
+        run = []
+        groups = 0
+        for kt in kts:
+            if not _mergeable(kt):
+                if run:
+                    matchers.append(_combine(run))
+                    run, groups = [], 0
+                matchers.append((kt[0], [kt]))
+                continue
+            if groups + kt[0].groups + 1 > _MAX_GROUPS:
+                matchers.append(_combine(run))
+                run, groups = [], 0
+            run.append(kt)
+            groups += kt[0].groups + 1
+        if run:
+            matchers.append(_combine(run))
+        return matchers
+    def _lookup(self, key):
+        index = self._get_index()
+        kts = tuple(index.candidates(key))
+        matchers = index.matchers.get(kts)
+        if matchers is None:
+            matchers = index.matchers[kts] = self._build(kts)
+        for combined, group in matchers:
+            m = combined.match(key)
+            if m:
+                if len(group) == 1:
+                    return group[0], m
+                kt = group[int(m.lastgroup[1:])]
+                # Rematch so the caller sees the pattern's own groups.
+                return kt, kt[0].match(key)
+        return None, None
+
+def _combine(kts):
+    if len(kts) == 1:
+        return kts[0][0], kts
+    pattern = '|'.join('(?P<_%d>%s)' % (i, kt[1]) for i, kt in enumerate(kts))
+    return re.compile(pattern), kts
@@ -0,0 +1,63 @@
+"""
+State kept per room, that goes away when the room goes quiet.
+"""
+
+import threading
+from collections import OrderedDict
+from scheduler import clock
+
+class RoomStore(object):
+    """
+    A mapping from room JIDs to state made by factory() the first time a room
+    asks for it.  Rooms not asked about for ttl seconds are dropped by
+    sweep(), and beyond maxsize rooms the least recently used is dropped to
+    make room for a new one.  It is safe to share between threads.
+    """
+    def __init__(self, factory, ttl=3600, maxsize=1000):
+        self.factory = factory
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.evicted = 0
+        self._rooms = OrderedDict() # room -> (state, last used)
+        self._lock = threading.Lock()
+    def get(self, room):
+        """The state for room, made afresh if it has none."""
+        with self._lock:
+            try:
+                state, used = self._rooms.pop(room)
+            except KeyError:
+                state = self.factory()
+            self._rooms[room] = (state, clock())
+            if len(self._rooms) > self.maxsize:
+                self._rooms.popitem(last=False)
+                self.evicted += 1
+            return state
+    __getitem__ = get
+    def discard(self, room):
+        with self._lock:
+            self._rooms.pop(room, None)
+    def sweep(self, now=None):
+        """Drop the rooms idle for ttl seconds; returns how many there were."""
+        if now is None:
+            now = clock()
+        dropped = 0
+        with self._lock:
+            # Rooms are kept in the order they were last used, so the idle
+            # ones are all at the front.
+            while self._rooms:
+                room, (state, used) = next(self._rooms.iteritems())
+                if now - used < self.ttl:
+                    break
+                del self._rooms[room]
+                dropped += 1
+            self.evicted += dropped
+        return dropped
+    def __contains__(self, room):
+        return room in self._rooms
+    def __len__(self):
+        return len(self._rooms)
+    def __unicode__(self):
+        return "RoomStore(%d/%d, %d evicted)" % \
+                (len(self._rooms), self.maxsize, self.evicted)
+    __str__ = __unicode__
+    __repr__ = __unicode__
@@ -0,0 +1,176 @@
+"""
+A timer queue for running things later, or every so often.
+"""
+
+import os
+import sys
+import heapq
+import itertools
+import threading
+import time
+
+def _clock_gettime():
+    """
+    A clock() that reads CLOCK_MONOTONIC through ctypes, as Python 2's time
+    module has none; None if the C library doesn't have it.
+    """
+    import ctypes
+    import ctypes.util
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    # Older glibcs keep clock_gettime in librt.
+    for name in ('rt', 'c'):
+        path = ctypes.util.find_library(name)
+        if path is None:
+            continue
+        try:
+            clock_gettime = ctypes.CDLL(path, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        break
+    else:
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    CLOCK_MONOTONIC = 6 if sys.platform == 'darwin' else 1
+    def clock():
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)):
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return t.tv_sec + t.tv_nsec * 1e-9
+    try:
+        clock()
+    except OSError:
+        return None
+    return clock
+
+try:
+    from time import monotonic as clock
+except ImportError:
+    try:
+        clock = _clock_gettime()
+    except (ImportError, OSError):
+        clock = None
+    # Only as a last resort, as it jumps when the system time is set.
+    if clock is None:
+        clock = time.time
+
+def earliest(*timeouts):
+    """The smallest of timeouts that isn't None, or None."""
+    timeouts = [t for t in timeouts if t is not None]
+    if not timeouts:
+        return None
+    return min(timeouts)
+
+class Job(object):
+    """
+    A call waiting in a Scheduler.  Call cancel() to stop it from running
+    (again).
+    """
+    def __init__(self, scheduler, when, interval, fn, args):
+        self.scheduler = scheduler
+        self.when = when
+        self.interval = interval
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+    def cancel(self):
+        with self.scheduler._lock:
+            if not self.cancelled:
+                self.cancelled = True
+                self.scheduler._cancelled += 1
+    def __unicode__(self):
+        return "Job(%s, due in %.3fs)" % (getattr(self.fn, '__name__',
+                                                  self.fn),
+                                          self.when - clock())
+    __str__ = __unicode__
+    __repr__ = __unicode__
+
+class Scheduler(object):
+    """
+    A heap of jobs ordered by when they're due, on a monotonic clock where
+    there is one, which there is on Linux and macOS even under Python 2.
+    Adding a job is O(log n), however many are waiting.
+
+    Nothing runs by itself: call run_pending() whenever timeout() seconds
+    have passed.  If a job raises, on_error is called with the job and the
+    exception; without an on_error, the exception propagates.
+
+    Jobs may be added or cancelled from any thread.
+    """
+    def __init__(self, on_error=None):
+        self.on_error = on_error
+        self._lock = threading.Lock()
+        self._heap = []
+        self._seq = itertools.count()
+        self._cancelled = 0
+    def __push(self, job):
+        with self._lock:
+            heapq.heappush(self._heap, (job.when, next(self._seq), job))
+    def schedule_in(self, delay, fn, *args):
+        """Call fn(*args) once, delay seconds from now."""
+        job = Job(self, clock() + delay, None, fn, args)
+        self.__push(job)
+        return job
+    def schedule_at(self, when, fn, *args):
+        """Call fn(*args) once, at when, in seconds since the epoch."""
+        return self.schedule_in(when - time.time(), fn, *args)
+    def schedule_every(self, interval, fn, *args):
+        """
+        Call fn(*args) every interval seconds, starting interval from now.
+        """
+        if interval <= 0:
+            raise ValueError, "interval must be positive"
+        job = Job(self, clock() + interval, interval, fn, args)
+        self.__push(job)
+        return job
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+    def __discard_cancelled(self):
+        heap = self._heap
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+            self._cancelled -= 1
+        if self._cancelled > 64 and self._cancelled * 2 > len(heap):
+            self._heap = [e for e in heap if not e[2].cancelled]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+    def timeout(self):
+        """
+        Seconds until the next job is due, 0 if one is overdue, or None if
+        there are no jobs at all.
+        """
+        with self._lock:
+            self.__discard_cancelled()
+            if not self._heap:
+                return None
+            due = self._heap[0][0]
+        return max(0, due - clock())
+    def run_pending(self):
+        """Run every job that is due, and return how many ran."""
+        ran = 0
+        now = clock()
+        while True:
+            with self._lock:
+                heap = self._heap
+                if not heap or heap[0][0] > now:
+                    break
+                when, seq, job = heapq.heappop(heap)
+                if job.cancelled:
+                    self._cancelled -= 1
+                    continue
+                if job.interval is None:
+                    job.cancelled = True
+            if job.interval is not None:
+                # Stay on the original grid, skipping any ticks we missed.
+                missed = int((now - when) / job.interval) + 1
+                job.when = when + missed * job.interval
+                self.__push(job)
+            ran += 1
+            try:
+                job.fn(*job.args)
+            except Exception, e:
+                if self.on_error is None:
+                    raise
+                self.on_error(job, e)
+        return ran
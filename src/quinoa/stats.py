@@ -0,0 +1,168 @@
+"""
+Counting and timing what a bot does, per command.
+"""
+
+import os
+import bisect
+import tempfile
+import threading
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram(object):
+    """
+    Counts observations into fixed buckets, so recording one is a binary
+    search and an increment, and quantiles are estimated from the buckets.
+    """
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+    def quantile(self, q):
+        """
+        The upper bound of the bucket holding the q-th quantile, or None if
+        it's past the last bound or nothing has been observed.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return None
+
+def _labels(command):
+    if command is None:
+        return ''
+    return '{command="%s"}' % command.replace('\\', r'\\').replace('"', r'\"')
+
+def _le(command, bound):
+    le = 'le="%s"' % bound
+    if command is None:
+        return '{%s}' % le
+    return _labels(command)[:-1] + ',' + le + '}'
+
+class Stats(object):
+    """
+    Counters and latency histograms, each kept per command name, or under
+    None for the bot as a whole.  Safe to update from any thread.
+
+    The bot records:
+        commands_total          commands run
+        command_errors_total    commands that raised
+        resolve_seconds         looking up the command for a message
+        queue_wait_seconds      waiting for a worker, with workers set
+        handler_seconds         running the command
+        outbox_wait_seconds     replies waiting in the outbox (bot-wide)
+        send_seconds            writing stanzas to the socket (bot-wide)
+    """
+    def __init__(self, prefix='quinoa_', bounds=BUCKETS):
+        self.prefix = prefix
+        self.bounds = bounds
+        self._lock = threading.Lock()
+        self._counters = {} # name -> {command: n}
+        self._histograms = {} # name -> {command: Histogram}
+    def count(self, name, command=None, n=1):
+        with self._lock:
+            counters = self._counters.setdefault(name, {})
+            counters[command] = counters.get(command, 0) + n
+    def observe(self, name, command, seconds):
+        with self._lock:
+            histograms = self._histograms.setdefault(name, {})
+            histogram = histograms.get(command)
+            if histogram is None:
+                histogram = histograms[command] = Histogram(self.bounds)
+            histogram.observe(seconds)
+    def counter(self, name, command=None):
+        with self._lock:
+            return self._counters.get(name, {}).get(command, 0)
+    def histogram(self, name, command=None):
+        with self._lock:
+            return self._histograms.get(name, {}).get(command)
+    def clear(self):
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+    def summary(self):
+        """
+        A line per command, busiest first, with its count, errors and
+        handler latencies.
+        """
+        with self._lock:
+            runs = dict(self._counters.get('commands_total', {}))
+            errors = dict(self._counters.get('command_errors_total', {}))
+            handlers = self._histograms.get('handler_seconds', {})
+            waits = self._histograms.get('queue_wait_seconds', {})
+            rows = []
+            for command, h in handlers.iteritems():
+                wait = waits.get(command)
+                rows.append((h.sum, command, h.count, h.quantile(0.5),
+                             h.quantile(0.95),
+                             wait.quantile(0.95) if wait else None))
+        if not rows:
+            return "No commands run yet."
+        def ms(seconds):
+            if seconds is None:
+                return ">%gms" % (self.bounds[-1] * 1000)
+            return "%gms" % (seconds * 1000)
+        lines = []
+        for total, command, n, p50, p95, wait in sorted(rows, reverse=True):
+            line = "%s: %d run, %d failed, p50 %s, p95 %s, %.3fs total" % (
+                    command, runs.get(command, n), errors.get(command, 0),
+                    ms(p50), ms(p95), total)
+            if wait is not None:
+                line += ", p95 queue wait %s" % ms(wait)
+            lines.append(line)
+        return "\n".join(lines)
+    def exposition(self):
+        """Everything recorded, in the Prometheus text format."""
+        out = []
+        with self._lock:
+            for name in sorted(self._counters):
+                metric = self.prefix + name
+                out.append("# TYPE %s counter" % metric)
+                for command, n in sorted(self._counters[name].iteritems()):
+                    out.append("%s%s %d" % (metric, _labels(command), n))
+            for name in sorted(self._histograms):
+                metric = self.prefix + name
+                out.append("# TYPE %s histogram" % metric)
+                for command, h in sorted(self._histograms[name].iteritems()):
+                    seen = 0
+                    for bound, n in zip(h.bounds, h.counts):
+                        seen += n
+                        out.append("%s_bucket%s %d" % (metric,
+                                                       _le(command, bound),
+                                                       seen))
+                    out.append("%s_bucket%s %d" % (metric,
+                                                   _le(command, '+Inf'),
+                                                   h.count))
+                    out.append("%s_sum%s %r" % (metric, _labels(command),
+                                                h.sum))
+                    out.append("%s_count%s %d" % (metric, _labels(command),
+                                                  h.count))
+        return "\n".join(out) + "\n"
+    def write(self, path):
+        """
+        Write exposition() to path, replacing it in one step so a scraper
+        never reads half a file.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.quinoa-stats')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.exposition())
+            os.chmod(tmp, 0644)
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
@@ -0,0 +1,169 @@
+"""
+Running one bot account as several processes, each in charge of some of its
+rooms.
+
+    quinoa --jid bot@example.com --shards 4 --rooms-file rooms.txt \\
+        mybots:MyBot
+
+Each shard is a separate connection, under its own resource, that joins its
+share of the rooms.  Shard 0 alone has a non-negative presence priority, so
+the server routes private messages to it.  Shards that die are restarted.
+"""
+
+import os
+import sys
+import time
+import zlib
+import signal
+import multiprocessing
+from optparse import OptionParser
+
+def shard_of(room, shards):
+    """The shard a room belongs to; stable across restarts."""
+    return (zlib.crc32(room.lower().encode('utf-8')) & 0xffffffff) % shards
+
+def _serve_shard(factory, shard, rooms):
+    # Leave SIGTERM to its default, so the supervisor can stop us, and don't
+    # forward SIGUSR1 as the supervisor does; the bot handles it once it's
+    # serving.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    bot = factory(shard)
+    bot.autojoin = rooms
+    bot.priority = 0 if shard == 0 else -1
+    bot.serve()
+
+class Supervisor(object):
+    """
+    Splits rooms between shards processes, each serving factory(shard), and
+    keeps them running.  A shard that keeps dying soon after starting is
+    restarted after longer and longer delays, up to max_restart_delay.
+    """
+    def __init__(self, factory, rooms, shards=1, log=None,
+                 restart_delay=1, max_restart_delay=60):
+        if getattr(log, 'write', False):
+            self.__log = log
+        else:
+            self.__log = sys.stdout
+        self.factory = factory
+        self.shards = shards
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.rooms = [[] for i in range(shards)]
+        for room in rooms:
+            self.rooms[shard_of(room, shards)].append(room)
+        self._processes = [None] * shards
+        self._started = [0] * shards
+        self._delays = [restart_delay] * shards
+        self._due = [0] * shards
+        self._finished = False
+    def log(self, text):
+        self.__log.write("%s: %s\n" % (self.__class__.__name__, text))
+    def __start(self, shard):
+        process = multiprocessing.Process(target=_serve_shard,
+                args=(self.factory, shard, self.rooms[shard]),
+                name="quinoa-shard-%d" % shard)
+        process.start()
+        self._processes[shard] = process
+        self._started[shard] = time.time()
+        self.log("Started shard %d (pid %d) with %d rooms." %
+                 (shard, process.pid, len(self.rooms[shard])))
+    def __check(self, shard):
+        process = self._processes[shard]
+        now = time.time()
+        if process is not None:
+            if process.is_alive():
+                return
+            self._processes[shard] = None
+            if now - self._started[shard] < self.max_restart_delay:
+                self._delays[shard] = min(self._delays[shard] * 2,
+                                          self.max_restart_delay)
+            else:
+                self._delays[shard] = self.restart_delay
+            self._due[shard] = now + self._delays[shard]
+            self.log("Shard %d exited with %s; restarting in %gs." %
+                     (shard, process.exitcode, self._delays[shard]))
+        if now >= self._due[shard]:
+            self.__start(shard)
+    def stop(self, *args):
+        self._finished = True
+    def toggle_profiling(self, *args):
+        """Pass SIGUSR1 on to every shard, so each toggles its profiling."""
+        for process in self._processes:
+            if process is not None and process.pid is not None:
+                try:
+                    os.kill(process.pid, signal.SIGUSR1)
+                except OSError:
+                    pass # It's just died; __check will restart it.
+    def serve(self):
+        """
+        Start every shard, and restart them as needed until stopped.  SIGUSR1
+        toggles profiling on every shard.
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self.toggle_profiling)
+        for shard in range(self.shards):
+            self.__start(shard)
+        try:
+            while not self._finished:
+                time.sleep(0.5)
+                for shard in range(self.shards):
+                    self.__check(shard)
+        except KeyboardInterrupt:
+            pass
+        for process in self._processes:
+            if process is not None:
+                process.terminate()
+        for process in self._processes:
+            if process is not None:
+                process.join()
+
+def load_class(path):
+    """Import a class given as package.module:Class."""
+    module, name = path.split(':')
+    return getattr(__import__(module, fromlist=[name]), name)
+
+class _Factory(object):
+    # A picklable way of making a bot for a shard.
+    def __init__(self, cls, jid, resource, password):
+        self.cls = cls
+        self.jid = jid
+        self.resource = resource
+        self.password = password
+    def __call__(self, shard):
+        return self.cls(self.jid, "%s-%d" % (self.resource, shard),
+                        self.password)
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options] package.module:BotClass")
+    parser.add_option("-j", "--jid", help="the bot's Jabber ID")
+    parser.add_option("-r", "--resource",
+            help="resource prefix; shards add -0, -1, ...")
+    parser.add_option("-p", "--password", default=os.environ.get(
+            'QUINOA_PASSWORD'),
+            help="password (default: $QUINOA_PASSWORD)")
+    parser.add_option("-n", "--shards", type="int", default=1,
+            help="number of processes to split rooms between")
+    parser.add_option("--room", action="append", dest="rooms", default=[],
+            help="room@service to join; may be repeated")
+    parser.add_option("--rooms-file",
+            help="file of room@service JIDs to join, one per line")
+    opts, args = parser.parse_args(argv)
+    if len(args) != 1 or not opts.jid:
+        parser.error("a bot class and --jid are required")
+    if opts.shards < 1:
+        parser.error("--shards must be at least 1")
+    cls = load_class(args[0])
+    rooms = list(opts.rooms)
+    if opts.rooms_file:
+        with open(opts.rooms_file) as f:
+            rooms.extend(line.strip() for line in f
+                         if line.strip() and not line.startswith('#'))
+    factory = _Factory(cls, opts.jid, opts.resource or cls.__name__,
+                       opts.password)
+    Supervisor(factory, rooms, opts.shards).serve()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Running a bot without a server, for tests and benchmarks.
+
+    harness = Harness(MyBot('bot@example.com', 'Bot', 'secret'))
+    harness.say("roll 5")   # -> ['...'], the bot's replies
+"""
+
+from collections import deque
+import xmppony as xmpp
+
+class FakeClient(object):
+    """
+    Stands in for xmpp.client.Client, in memory.  Stanzas given to deliver()
+    are passed to the registered handlers by Process(), and everything sent
+    is kept in self.sent.
+    """
+    def __init__(self, server=None, debug=None):
+        self.server = server
+        self.handlers = {} # stanza name -> [(type, namespace, handler)]
+        self.incoming = deque()
+        self.sent = []
+        self.connected = False
+        self.Connection = None
+    def connect(self, *args, **kwargs):
+        self.connected = True
+        return 'tcp'
+    def auth(self, user, password, resource='', *args, **kwargs):
+        return 'sasl'
+    def disconnect(self):
+        self.connected = False
+    def isConnected(self):
+        return self.connected
+    def RegisterHandler(self, name, handler, typ='', ns='', *args, **kwargs):
+        self.handlers.setdefault(name, []).append((typ, ns, handler))
+    def sendInitPresence(self, requestRoster=1):
+        self.send(xmpp.protocol.Presence())
+    def send(self, stanza):
+        self.sent.append(stanza)
+    def deliver(self, stanza):
+        """Queue a stanza as if it had come from the server."""
+        self.incoming.append(stanza)
+    def dispatch(self, stanza):
+        """Pass stanza to the handlers registered for it, in order."""
+        kind = stanza.getType() or ''
+        namespaces = set(child.getNamespace()
+                         for child in stanza.getChildren())
+        for typ, ns, handler in self.handlers.get(stanza.getName(), []):
+            if typ and typ != kind or ns and ns not in namespaces:
+                continue
+            try:
+                handler(self, stanza)
+            except xmpp.NodeProcessed:
+                return
+    def Process(self, timeout=0):
+        """
+        Dispatch one delivered stanza, returning '0' if there were none, or
+        0 if disconnected, as the real dispatcher does.
+        """
+        if not self.connected:
+            return 0
+        if not self.incoming:
+            return '0'
+        stanza = self.incoming.popleft()
+        self.dispatch(stanza)
+        return len(unicode(stanza))
+
+class Harness(object):
+    """
+    Connects bot to a FakeClient, and talks to it.  Replies are captured as
+    the bot makes them, before the outbox paces them, so say() returns them
+    at once.  Commands run in the calling thread, so leave workers unset.
+    """
+    def __init__(self, bot, who='tester@example.com/test'):
+        self.bot = bot
+        self.who = who
+        self.client = FakeClient(bot.jid.getDomain())
+        self.replies = [] # (to, text, type)
+        bot.make_client = lambda: self.client
+        bot._send = self.__capture
+        if not bot.start():
+            raise IOError, "Couldn't start %s." % bot
+    def __capture(self, to_jid, text, type):
+        self.replies.append((unicode(to_jid), text, type))
+    def message(self, body, frm=None, type='chat'):
+        """A message from frm, or self.who, to the bot."""
+        return xmpp.protocol.Message(to=self.bot.jid, body=body, typ=type,
+                                     frm=frm or self.who)
+    def deliver(self, stanza):
+        """Have the bot handle stanza, and return the texts it replied."""
+        start = len(self.replies)
+        self.client.deliver(stanza)
+        self.bot.pump()
+        return [text for to, text, type in self.replies[start:]]
+    def say(self, body, frm=None, type='chat'):
+        """Say body to the bot, and return the texts it replied."""
+        return self.deliver(self.message(body, frm, type))
+    def stop(self):
+        self.bot.stop()
@@ -0,0 +1,174 @@
+"""
+The dice bot's big rolls, with NumPy.
+
+Each function here gives the same answers, in the same words, as the one of
+the same name in quinoa.dicebot, but draws a whole pool (or a whole wave of
+rerolls) as one array and counts it up with array operations, so a pool of a
+million dice is a matter of milliseconds rather than seconds.  Pools are kept
+as counts of each face where the order the dice are listed in allows it.
+
+NumPy is optional; if it isn't installed, available is False and the dice
+bot rolls everything with the plain functions.  It isn't imported until the
+first roll that needs it, so a bot that never rolls that many dice never
+loads it.
+"""
+
+import os
+import imp
+from random import randint as rand
+
+try:
+    imp.find_module('numpy')
+    available = True
+except ImportError:
+    available = False
+
+numpy = None
+
+# Dice bigger than this are rolled one at a time, as NumPy can't draw them.
+MAX_SIZE = 2 ** 62
+
+_generators = {} # process id -> generator
+
+def _numpy():
+    """NumPy, imported the first time it's needed."""
+    global numpy
+    if numpy is None:
+        import numpy as module
+        numpy = module
+    return numpy
+
+def _random():
+    """
+    A generator of its own for this process.  Processes forked for the roll
+    pool would otherwise all start from the same state, and roll the same.
+    """
+    pid = os.getpid()
+    generator = _generators.get(pid)
+    if generator is None:
+        generator = _generators[pid] = _numpy().random.RandomState()
+    return generator
+
+def _roll(dice, size):
+    """An array of dice dice of size size."""
+    return _random().randint(1, size + 1, dice)
+
+def _counts(values, size):
+    """How many of values came up as each face, indexed by face."""
+    return _numpy().bincount(values, minlength=size + 1)
+
+def _at_least(counts, face):
+    return int(counts[max(face, 0):].sum())
+
+def _listing(counts):
+    """Every die counted in counts, lowest first, as dicebot lists them."""
+    return ''.join(('%d, ' % face) * int(n)
+                   for face, n in enumerate(counts) if n)[:-2]
+
+def _array_listing(values, size):
+    """The dice in values in the order they were drawn."""
+    if size > len(values):
+        return ', '.join(map(str, values.tolist()))
+    # Formatting each face once and looking them up is much quicker.
+    faces = _numpy().array(['%d, ' % face for face in range(size + 1)],
+                        dtype=object)
+    return ''.join(faces[values].tolist())[:-2]
+
+def owod(dice, diff, spec=False, will=False):
+    counts = _counts(_roll(dice, 10), 10)
+    # Only ones in the first roll count against it.
+    ones = int(counts[1])
+    if spec:
+        tens = counts[10]
+        while tens:
+            wave = _counts(_roll(tens, 10), 10)
+            counts += wave
+            tens = wave[10]
+    succs = _at_least(counts, diff)
+    if will:
+        succs += 1
+    if not succs and ones:
+        succs = 'Botch!'
+    else:
+        succs = max(0, succs - ones)
+    return "%s (%s)" % (succs, _listing(counts))
+
+def nwod(dice, again=10, rote=False):
+    threshold = 8
+    chance = False
+    if dice < 1:
+        dice = 1
+        threshold = 10
+        again = 10
+        chance = True
+    counts = _counts(_roll(dice, 10), 10)
+    if chance and counts[1]:
+        return "Critical failure! (%s)" % _listing(counts)
+    # The rerolled failures take the places of the lowest dice, so they come
+    # first, in the order they were rolled, then the rest in order.
+    rerolled = None
+    if rote:
+        rerolled = _roll(_at_least(counts, 0) - _at_least(counts, threshold),
+                         10)
+        counts[:threshold] = 0
+    total = counts.copy()
+    if rerolled is not None:
+        total += _counts(rerolled, 10)
+    waves = []
+    explode = _at_least(total, again)
+    while explode:
+        wave = _counts(_roll(explode, 10), 10)
+        waves.append(wave)
+        total += wave
+        explode = _at_least(wave, again)
+    listing = [_listing(c) for c in [counts] + waves]
+    if rerolled is not None:
+        listing.insert(0, _array_listing(rerolled, 10))
+    listing = ', '.join(l for l in listing if l)
+    successes = _at_least(total, threshold)
+    if not successes:
+        return "Failure (%s)" % listing
+    return "Success %s (%s)" % (successes, listing)
+
+def exalted(dice):
+    counts = _counts(_roll(dice, 10), 10)
+    succs = _at_least(counts, 7) + int(counts[10])
+    ones = int(counts[1])
+    if not succs and ones:
+        return "Botch (x%s)" % ones
+    if not succs and not ones:
+        return "Failure."
+    return "%s successes." % succs
+
+def ork(dice):
+    counts = _counts(_roll(dice, 6), 6)
+    vals = [int(n) + face - 1 for face, n in enumerate(counts) if n]
+    vals.sort()
+    vals.reverse()
+    return ', '.join(map(str, vals))
+
+def wushu(dice, trait):
+    return "%s" % int((_roll(dice, 6) <= trait).sum())
+
+def shadowrun(pool, leftover, ro6):
+    counts = _counts(_roll(pool, 6), 7)
+    if ro6:
+        sixes = counts[6]
+        while sixes:
+            wave = _counts(_roll(sixes, 6), 7)
+            counts += wave
+            sixes = wave[6]
+    counts[7] += leftover
+    glitch = counts[1] > (counts.sum() / 2.)
+    successes = _at_least(counts, 5)
+    listing = _listing(counts)
+    if glitch and not successes:
+        return "Critical glitch! (%s)" % listing
+    if glitch:
+        return "%s hits and a glitch. (%s)" % (successes, listing)
+    return "%s hits. (%s)" % (successes, listing)
+
+def generic(num, size):
+    if size > MAX_SIZE:
+        return ', '.join(str(rand(1, size)) for x in range(num))
+    return _array_listing(_roll(num, size), size)
@@ -0,0 +1,130 @@
+"""
+The dice bot, run through quinoa.testing.Harness.
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import time
+import unittest
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+try:
+    import xmppony as xmpp
+except ImportError:
+    xmpp = None
+
+ROOM = 'game@rooms.example.com'
+
+@unittest.skipIf(xmpp is None, "xmppony isn't installed")
+class RoomTest(unittest.TestCase):
+    def setUp(self):
+        from quinoa.dicebot import DiceBot
+        from quinoa.testing import Harness
+        self.bot = DiceBot('tyche@example.com', 'Tyche', 'secret')
+        self.harness = Harness(self.bot)
+        self.bot.join_room(ROOM)
+        # The room answers the join with our own presence.
+        self.harness.deliver(xmpp.protocol.Presence(frm=ROOM + '/Tyche'))
+    def tearDown(self):
+        self.harness.stop()
+    def say(self, body, nick='someone'):
+        return self.harness.say(body, frm=ROOM + '/' + nick, type='groupchat')
+    def test_joined(self):
+        self.assertEqual(self.bot.rooms[ROOM], 'Tyche')
+    def test_game_state_is_per_room(self):
+        self.assertEqual(self.say("mode owod"), ["Mode set: owod"])
+        self.assertEqual(self.say("mode"), ["owod"])
+        self.assertEqual(self.harness.say("mode"), ["nwod"])
+        self.assertEqual(self.bot.rooms[ROOM], 'Tyche')
+    def test_ignores_itself(self):
+        self.assertEqual(self.say("mode", nick='Tyche'), [])
+    def test_leave(self):
+        self.assertEqual(self.harness.say("leave " + ROOM), ["Left."])
+        self.assertFalse(ROOM in self.bot.rooms)
+    def test_lost_connection(self):
+        self.harness.client.disconnect()
+        self.assertRaises(IOError, self.bot.process, 0)
+    def test_endless_explosions(self):
+        self.assertEqual(self.harness.say("roll 5 1"),
+                         ["Every die would explode forever."])
+    def test_shadowrun_leftover_cost(self):
+        self.harness.say("mode shadowrun")
+        self.assertEqual(self.harness.say("roll 1 1000000000"),
+                         ["Too many dice; the most I'll roll is %d." %
+                          self.bot.max_dice])
+    def test_shadowrun_leftover_odds(self):
+        from quinoa import odds
+        self.harness.say("mode shadowrun")
+        self.assertEqual(self.harness.say("odds 1 1000000000"),
+                         ["Too many dice; the most I'll work out odds for "
+                          "is %d." % self.bot.max_odds_dice])
+        self.assertFalse(('shadowrun', 1, 1000000000, None) in odds.cache)
+    def test_exploding_expression_cost(self):
+        self.assertEqual(self.harness.say("roll 900d1000!2"),
+                         ["Too many dice; the most I'll roll is %d." %
+                          self.bot.max_dice])
+    def test_pooled_rolls_share_a_pool(self):
+        self.bot.offload_dice = 0
+        threads = [threading.Thread(target=self.harness.say, args=("roll 5",))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pool = self.bot._pool
+        try:
+            self.assertEqual(set(p for msg, p in self.bot._rolls.values()),
+                             set([pool]) if self.bot._rolls else set())
+            end = time.time() + 5
+            while self.bot._rolls and time.time() < end:
+                time.sleep(0.05)
+            self.assertEqual(len(self.harness.replies), 4)
+        finally:
+            pool.terminate()
+    def test_deeply_nested_expression(self):
+        self.assertEqual(self.harness.say("roll " + "(" * 1000 + "1d6"),
+                         ["That roll is too long."])
+        self.assertEqual(self.harness.say("roll " + "(" * 40 + "1d6" +
+                                          ")" * 40),
+                         ["That roll is nested too deep."])
+        self.assertEqual(self.harness.say("roll " + "-" * 40 + "1d6"),
+                         ["That roll is nested too deep."])
+    def test_polls_for_pooled_rolls(self):
+        self.bot._rolls[0] = (None, None)
+        self.assertTrue(self.bot.timeout() <= self.bot.busy_poll_interval)
+    def test_shard_joins_only_its_rooms(self):
+        from quinoa.dicebot import DiceBot
+        from quinoa.testing import Harness
+        bot = DiceBot('tyche@example.com', 'Tyche-1', 'secret')
+        bot.autojoin = [ROOM]
+        harness = Harness(bot)
+        try:
+            self.assertTrue(ROOM in bot.joins)
+            self.assertEqual(len(bot.joins), 1)
+        finally:
+            harness.stop()
+    def test_disconnect_rejoins(self):
+        self.say("mode owod")
+        self.bot.disconnect()
+        self.assertEqual(self.bot.rooms, {})
+        self.assertTrue(self.bot.start())
+        self.assertTrue(ROOM in self.bot.joins)
+
+@unittest.skipIf(xmpp is None, "xmppony isn't installed")
+class ImportTest(unittest.TestCase):
+    def test_numpy_is_lazy(self):
+        code = ("import sys, quinoa.dicebot; "
+                "sys.exit('numpy' in sys.modules)")
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        self.assertEqual(subprocess.call([sys.executable, '-c', code],
+                                         env=env), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+"""
+Command plugins from entry points, given fake distributions.
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'src'))
+# plugins needs nothing from the rest of the package, so it can be tested
+# without xmppony.
+sys.path.append(os.path.join(here, '..', 'src', 'quinoa'))
+
+import plugins
+
+try:
+    import xmppony as xmpp
+except ImportError:
+    xmpp = None
+
+try:
+    import pkg_resources
+except ImportError:
+    pkg_resources = None
+
+class FakeEntryPoint(object):
+    """An entry point for fn that counts how often it's resolved."""
+    def __init__(self, name, fn):
+        self.name = name
+        self.attrs = (fn.__name__,)
+        self.fn = fn
+        self.resolved = 0
+    def resolve(self):
+        self.resolved += 1
+        return self.fn
+
+class FakeDist(object):
+    project_name = 'fake'
+    def __init__(self, *entry_points, **kwargs):
+        self.group = kwargs.get('group', plugins.GROUP)
+        self.entry_points = entry_points
+    def get_entry_map(self, group):
+        if group != self.group:
+            return {}
+        return dict((ep.name, ep) for ep in self.entry_points)
+
+def fortune(bot, msg):
+    """Tells your fortune."""
+    return "You will write a test."
+
+def echo(bot, msg, match):
+    """Says it back."""
+    return msg.getBody()[match.end():].strip()
+echo.takes_match = True
+
+class PatternTest(unittest.TestCase):
+    def test_word(self):
+        self.assertEqual(plugins.pattern_of('fortune'), r'[Ff]ortune\b')
+    def test_regex(self):
+        self.assertEqual(plugins.pattern_of(r're:(?i)tell me a (joke|story)$'),
+                         r'(?i)tell me a (joke|story)$')
+    def test_punctuation(self):
+        self.assertEqual(plugins.pattern_of('!roll'), r'\!roll\b')
+
+class EntryPointsTest(unittest.TestCase):
+    def test_from_dists(self):
+        a, b = FakeEntryPoint('b', fortune), FakeEntryPoint('a', fortune)
+        self.assertEqual(plugins.entry_points(dists=[FakeDist(a, b)]), [b, a])
+    def test_other_group(self):
+        dist = FakeDist(FakeEntryPoint('a', fortune), group='other')
+        self.assertEqual(plugins.entry_points(dists=[dist]), [])
+        self.assertEqual(len(plugins.entry_points('other', [dist])), 1)
+    def test_not_resolved(self):
+        entry_point = FakeEntryPoint('fortune', fortune)
+        plugins.entry_points(dists=[FakeDist(entry_point)])
+        command = plugins.LazyCommand(entry_point, None)
+        self.assertEqual(entry_point.resolved, 0)
+        self.assertFalse(command.loaded)
+        self.assertEqual(command.__doc__, "Tells your fortune.")
+        self.assertEqual(entry_point.resolved, 1)
+
+def plugin_bot(*entry_points):
+    """A Harness for a bot with only the given plugins."""
+    from quinoa import Bot
+    from quinoa.testing import Harness
+    dists = [FakeDist(*entry_points)]
+    class PluginBot(Bot):
+        def register_commands(self):
+            self.added = self.load_plugins(dists=dists)
+    return Harness(PluginBot('bot@example.com', 'Bot', 'secret'))
+
+@unittest.skipIf(xmpp is None, "xmppony isn't installed")
+class LoadTest(unittest.TestCase):
+    def setUp(self):
+        self.fortune = FakeEntryPoint('fortune', fortune)
+        self.echo = FakeEntryPoint('echo', echo)
+        self.help = FakeEntryPoint('help', fortune)
+        self.harness = plugin_bot(self.fortune, self.echo, self.help)
+    def tearDown(self):
+        self.harness.stop()
+    def test_lazy(self):
+        self.assertEqual(self.fortune.resolved, 0)
+        self.assertEqual(self.harness.say("fortune"),
+                         ["You will write a test."])
+        self.assertEqual(self.harness.say("Fortune"),
+                         ["You will write a test."])
+        self.assertEqual(self.fortune.resolved, 1)
+        self.assertEqual(self.echo.resolved, 0)
+    def test_takes_match(self):
+        self.assertEqual(self.harness.say("echo hello"), ["hello"])
+    def test_earlier_commands_win(self):
+        # Bot's own help was registered first.
+        self.assertEqual(self.harness.bot.added, 2)
+        self.assertEqual(self.help.resolved, 0)
+        self.assertNotEqual(self.harness.say("help fortune"),
+                            ["You will write a test."])
+
+@unittest.skipIf(xmpp is None, "xmppony isn't installed")
+@unittest.skipIf(pkg_resources is None, "setuptools isn't installed")
+class BrokenTest(unittest.TestCase):
+    def setUp(self):
+        parse = pkg_resources.EntryPoint.parse
+        self.harness = plugin_bot(
+                parse('missing = quinoa_no_such_module:fn'),
+                parse('broken = os:no_such_function'),
+                FakeEntryPoint('fortune', fortune))
+    def tearDown(self):
+        self.harness.stop()
+    def test_missing_module(self):
+        reply, = self.harness.say("missing")
+        self.assertTrue(reply.startswith("Bad command:"), reply)
+        self.assertTrue(self.harness.say("help missing")[0]
+                        .startswith("Couldn't load missing:"))
+    def test_missing_function(self):
+        reply, = self.harness.say("broken")
+        self.assertTrue(reply.startswith("Bad command:"), reply)
+    def test_others_still_work(self):
+        self.harness.say("missing")
+        self.assertEqual(self.harness.say("fortune"),
+                         ["You will write a test."])
+
+@unittest.skipIf(xmpp is None, "xmppony isn't installed")
+@unittest.skipIf(pkg_resources is None, "setuptools isn't installed")
+class CardsTest(unittest.TestCase):
+    """quinoa.cards, loaded as the dice bot's setup.py declares it."""
+    def setUp(self):
+        from quinoa.dicebot import DiceBot
+        from quinoa.testing import Harness
+        names = ['shuffle', 'deal', 'reveal', 'peek', 'discard', 'finish']
+        dist = FakeDist(*[pkg_resources.EntryPoint.parse(
+                '%s = quinoa.cards:%s' % (name, name)) for name in names])
+        class CardBot(DiceBot):
+            def load_plugins(self, group=plugins.GROUP, dists=None):
+                return DiceBot.load_plugins(self, group, [dist])
+        self.harness = Harness(CardBot('tyche@example.com', 'Tyche', 'x'))
+    def tearDown(self):
+        self.harness.stop()
+    def test_deal(self):
+        self.assertEqual(self.harness.say("shuffle"), ["52-card deck ready."])
+        reply, = self.harness.say("deal me 5")
+        self.assertTrue(reply.startswith("5 cards dealt; 47 left."), reply)
+        reply, = self.harness.say("reveal my hand")
+        self.assertEqual(reply.count(" of "), 5)
+        self.assertEqual(self.harness.say("finish"),
+                         ["Deck and hands destroyed."])
+
+if __name__ == '__main__':
+    unittest.main()
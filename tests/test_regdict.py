@@ -0,0 +1,153 @@
+"""
+Command dispatch: RegDict and CompiledRegDict against a plain linear scan.
+
+    python -m unittest discover tests
+"""
+
+import os
+import re
+import sys
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'src'))
+# regdict needs nothing from the rest of the package, so it can be tested
+# without xmppony.
+sys.path.append(os.path.join(here, '..', 'src', 'quinoa'))
+
+from regdict import RegDict, CompiledRegDict, _prefix, _key
+
+# Commands like the bots register, in order, including ones with no literal
+# prefix, inline flags, groups of their own and alternations.
+PATTERNS = [
+    r'[Hh]elp\b',
+    r'[Rr]oll\b',
+    r'[Rr]oll (\d+)d(\d+)',
+    r'[Rr]ole\b',
+    r'(?i)batsignal\??$',
+    r'!\b',
+    r'[Ww]ho is\b',
+    r'(?i)tell me a (joke|story)$',
+    r'(?P<n>\d+) points? to (\w+)',
+    r'.*\bplease$',
+    r'(ha)+\b',
+    r'shuffle|deal\b',
+    r'[Mm]ode\b',
+    r'rick',
+]
+
+KEYS = [
+    'help', 'Help me', 'roll 3d6', 'Roll 3d6', 'roll', 'rolls', 'role',
+    'BATSIGNAL?', 'batsignal', '!y', 'who is kit', 'Tell me a JOKE',
+    '5 points to Gryffindor', '1 point to you', 'roll the dice please',
+    'hahaha', 'shuffle', 'deal me 3', 'mode owod', 'rickroll', 'nothing',
+    '', 'r', 'ro', 'please', 'modes',
+]
+
+def linear(patterns, key):
+    """The first pattern that matches key, and its match."""
+    for pattern in patterns:
+        m = re.match(pattern, key)
+        if m:
+            return pattern, m
+    return None, None
+
+class RegDictTest(unittest.TestCase):
+    cls = RegDict
+    cache_size = 0
+    def make(self, patterns=PATTERNS):
+        d = self.cls(cache_size=self.cache_size)
+        for pattern in patterns:
+            d[pattern] = pattern
+        return d
+    def test_first_registered_wins(self):
+        d = self.make([r'[Rr]oll\b', r'[Rr]oll (\d+)', r'.*'])
+        self.assertEqual(d['roll 5'], r'[Rr]oll\b')
+        self.assertEqual(d['anything'], r'.*')
+        d = self.make([r'.*', r'[Rr]oll\b'])
+        self.assertEqual(d['roll 5'], r'.*')
+    def test_same_as_linear_scan(self):
+        d = self.make()
+        for key in KEYS:
+            expected, expected_m = linear(PATTERNS, key)
+            value, m = d.resolve(key)
+            self.assertEqual(value, expected, key)
+            if expected is not None:
+                self.assertEqual(m.group(0), expected_m.group(0), key)
+                self.assertEqual(m.groups(), expected_m.groups(), key)
+                self.assertEqual(m.groupdict(), expected_m.groupdict(), key)
+            self.assertEqual(key in d, expected is not None, key)
+            self.assertEqual(d[key], expected, key)
+    def test_own_groups(self):
+        d = self.make()
+        value, m = d.resolve('5 points to Gryffindor')
+        self.assertEqual(m.group('n'), '5')
+        self.assertEqual(m.groups(), ('5', 'Gryffindor'))
+        value, m = d.resolve('Tell me a story')
+        self.assertEqual(m.groups(), ('story',))
+    def test_setitem_invalidates(self):
+        d = self.make([r'[Rr]oll\b'])
+        self.assertEqual(d['xyzzy'], None)
+        self.assertEqual(d['roll'], r'[Rr]oll\b')
+        d[r'xyz'] = 'new'
+        self.assertEqual(d['xyzzy'], 'new')
+        d[r'[Rr]oll\b'] = 'replaced'
+        self.assertEqual(d['roll'], 'replaced')
+    def test_delitem_invalidates(self):
+        d = self.make([r'[Rr]oll\b', r'.*'])
+        self.assertEqual(d['roll'], r'[Rr]oll\b')
+        del d[r'[Rr]oll\b']
+        self.assertEqual(d['roll'], r'.*')
+        self.assertEqual(d.pop(r'.*'), r'.*')
+        self.assertFalse('roll' in d)
+    def test_clear_invalidates(self):
+        d = self.make()
+        self.assertTrue('help' in d)
+        d.clear()
+        self.assertFalse('help' in d)
+    def test_only_strings(self):
+        d = self.make([])
+        self.assertRaises(KeyError, d.__setitem__, re.compile('x'), 1)
+
+class CachedRegDictTest(RegDictTest):
+    cache_size = 4
+    def test_cache(self):
+        d = self.make()
+        d.resolve('roll 3d6')
+        self.assertTrue('roll 3d6' in d.cache)
+        d[r'zzz'] = 'z'
+        self.assertEqual(len(d.cache), 0)
+
+class CompiledRegDictTest(RegDictTest):
+    cls = CompiledRegDict
+    def test_many_groups(self):
+        # More groups than one pattern may hold are split over several.
+        patterns = [r'(a)(b)%d$' % i for i in range(60)]
+        d = self.make(patterns)
+        for i in (0, 30, 59):
+            value, m = d.resolve('ab%d' % i)
+            self.assertEqual(value, r'(a)(b)%d$' % i)
+            self.assertEqual(m.groups(), ('a', 'b'))
+
+class CachedCompiledRegDictTest(CompiledRegDictTest):
+    cache_size = 4
+
+class PrefixTest(unittest.TestCase):
+    def prefix(self, source):
+        return _prefix(_key(source))
+    def test_literal(self):
+        self.assertEqual(self.prefix(r'[Rr]oll\b'), 'roll')
+        self.assertEqual(self.prefix(r'[Ww]ho is\b'), 'who is')
+        self.assertEqual(self.prefix(r'!\b'), '!')
+    def test_none(self):
+        self.assertEqual(self.prefix(r'.*\bplease$'), '')
+        self.assertEqual(self.prefix(r'shuffle|deal\b'), '')
+        self.assertEqual(self.prefix(r'(ha)+\b'), '')
+        self.assertEqual(self.prefix(r'(?i)batsignal'), '')
+    def test_quantified(self):
+        # The last character is optional, or may repeat.
+        self.assertEqual(self.prefix(r'rolls?'), 'roll')
+        self.assertEqual(self.prefix(r'ro+l'), 'ro')
+
+if __name__ == '__main__':
+    unittest.main()
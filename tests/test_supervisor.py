@@ -0,0 +1,87 @@
+"""
+The sharded runner, with shards that only wait for signals.
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import time
+import shutil
+import signal
+import tempfile
+import unittest
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+try:
+    import xmppony
+except ImportError:
+    xmppony = None
+
+class Shard(object):
+    """Stands in for a bot; touches a file each time it gets SIGUSR1."""
+    def __init__(self, directory, shard):
+        self.path = os.path.join(directory, str(shard))
+    def toggle_profiling(self, *args):
+        with open(self.path, 'a') as f:
+            f.write('x')
+    def serve(self):
+        signal.signal(signal.SIGUSR1, self.toggle_profiling)
+        while True:
+            time.sleep(0.1)
+
+class Factory(object):
+    def __init__(self, directory):
+        self.directory = directory
+    def __call__(self, shard):
+        return Shard(self.directory, shard)
+
+def _serve(directory, shards):
+    from quinoa.supervisor import Supervisor
+    log = open(os.devnull, 'w')
+    Supervisor(Factory(directory), [], shards, log=log).serve()
+
+def _wait_for(test, timeout=5):
+    end = time.time() + timeout
+    while not test() and time.time() < end:
+        time.sleep(0.05)
+    return test()
+
+@unittest.skipIf(xmppony is None, "xmppony isn't installed")
+class SupervisorTest(unittest.TestCase):
+    shards = 2
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.process = multiprocessing.Process(target=_serve,
+                                               args=(self.directory,
+                                                     self.shards))
+        self.process.start()
+    def tearDown(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join(5)
+        shutil.rmtree(self.directory)
+    def touched(self, shard):
+        path = os.path.join(self.directory, str(shard))
+        if not os.path.exists(path):
+            return 0
+        with open(path) as f:
+            return len(f.read())
+    def test_sigusr1_reaches_every_shard(self):
+        # Give the shards time to start and set up their handlers.
+        time.sleep(1)
+        os.kill(self.process.pid, signal.SIGUSR1)
+        for shard in range(self.shards):
+            self.assertTrue(_wait_for(lambda: self.touched(shard) == 1))
+        self.assertTrue(self.process.is_alive())
+    def test_sigterm_stops_shards(self):
+        time.sleep(1)
+        os.kill(self.process.pid, signal.SIGTERM)
+        self.process.join(5)
+        self.assertFalse(self.process.is_alive())
+
+if __name__ == '__main__':
+    unittest.main()